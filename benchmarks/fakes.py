@@ -0,0 +1,244 @@
+# coding=utf-8
+"""
+Stand-ins for OctoPrint file manager, printer and settings, good enough to drive the plugin offline
+"""
+from __future__ import absolute_import
+
+import queue
+import threading
+import time
+from typing import Dict, List, Optional
+
+
+class FakeFileManager:
+    """
+    Synthetic library of gcode files spread into folders, listed like octoprint.filemanager.FileManager does
+    """
+
+    def __init__(self, number_of_files: int, files_per_folder: int = 500):
+        self.files: Dict[str, int] = {}
+        for i in range(number_of_files):
+            self.add(f"folder_{i // files_per_folder:03d}/part {i:06d} PLA 0.2mm.gcode", 1600000000 + i)
+
+    def add(self, path: str, date: int):
+        self.files[path] = date
+
+    def remove(self, path: str):
+        self.files.pop(path, None)
+
+    def file_exists(self, destination, path: str) -> bool:
+        return path in self.files
+
+    def path_on_disk(self, destination, path: str) -> str:
+        # files don't exist, links are written without metadata
+        return f"/nonexistent/{path}"
+
+    @staticmethod
+    def _file_node(path: str, date: int) -> dict:
+        name = path.rsplit("/", 1)[-1]
+        return {
+            "type": "machinecode",
+            "typePath": ["machinecode", "gcode"],
+            "path": path,
+            "name": name,
+            "display": name,
+            "date": date,
+            "size": 1024,
+            "origin": "local",
+        }
+
+    def list_files(self, locations=None, path=None, filter=None, recursive=True, level=0, force_refresh=False):
+        tree: Dict[str, dict] = {}
+        for file_path, date in self.files.items():
+            folder, name = file_path.rsplit("/", 1) if "/" in file_path else ("", file_path)
+            node = self._file_node(file_path, date)
+            if filter is not None and not filter(node):
+                continue
+            if path is not None:
+                if folder == path:
+                    tree[name] = node
+            elif not folder:
+                tree[name] = node
+            else:
+                folder_node = tree.setdefault(folder, {
+                    "type": "folder",
+                    "typePath": ["folder"],
+                    "path": folder,
+                    "name": folder,
+                    "display": folder,
+                    "children": {},
+                })
+                if recursive:
+                    folder_node["children"][name] = node
+        return {"local": tree}
+
+
+class VirtualPrinter:
+    """
+    Printer that answers to the commands the plugin sends through plugin's received gcode hook,
+    with configurable latency per line
+    """
+
+    def __init__(self, plugin, line_latency: float = 0.002):
+        self._plugin = plugin
+        self.line_latency = line_latency
+        self.sd_files: Dict[str, int] = {}
+        # SD directories that don't exist, files can't be opened in them
+        self.missing_directories = set()
+        self._listing: List[dict] = []
+        self._writing: Optional[str] = None
+        self._printing = False
+        self.lines_received = 0
+        self.listings = 0
+
+        self._queue: "queue.Queue[str]" = queue.Queue()
+        self._worker = threading.Thread(target=self._process, daemon=True)
+        self._worker.start()
+
+    # ~~ printer interface used by the plugin
+
+    def is_operational(self) -> bool:
+        return True
+
+    def is_printing(self) -> bool:
+        return self._printing
+
+    def is_sd_ready(self) -> bool:
+        return True
+
+    def get_state_id(self) -> str:
+        return "PRINTING" if self._printing else "OPERATIONAL"
+
+    def connect(self, port=None, baudrate=None, profile=None):
+        pass
+
+    def select_file(self, path, sd, printAfterSelect=False, *args, **kwargs):
+        self.selected = path
+
+    def start_print(self, *args, **kwargs):
+        self._printing = True
+
+    def commands(self, commands, *args, **kwargs):
+        for command in commands if isinstance(commands, (list, tuple)) else [commands]:
+            self._queue.put(command)
+
+    def delete_sd_file(self, filename, *args, **kwargs):
+        self.commands([f"M30 /{filename}"])
+        self.refresh_sd_files()
+
+    def refresh_sd_files(self, blocking=False, *args, **kwargs):
+        self._list_sd(blocking)
+
+    def get_sd_files(self, *args, **kwargs):
+        if kwargs.get("refresh"):
+            self._list_sd(True)
+        return list(self._listing)
+
+    # ~~ simulation
+
+    def wait_idle(self):
+        """
+        Wait until all commands sent so far have been processed
+        """
+        self._queue.join()
+
+    def _list_sd(self, blocking: bool):
+        done = threading.Event()
+        self._queue.put(("M20", done))
+        if blocking:
+            done.wait()
+
+    def _reply(self, line: str):
+        self._plugin.hook_gcode_received(None, line)
+
+    def _process(self):
+        while True:
+            item = self._queue.get()
+            done = None
+            if isinstance(item, tuple):
+                item, done = item
+            time.sleep(self.line_latency)
+            self.lines_received += 1
+            self._execute(item.strip())
+            if done is not None:
+                done.set()
+            self._queue.task_done()
+
+    def _execute(self, command: str):
+        code = command.split(" ", 1)[0]
+        argument = command[len(code):].strip()
+
+        if self._writing is not None and code != "M29":
+            # Marlin stores everything but M29 while writing
+            self.sd_files[self._writing] += len(command) + 1
+        elif code == "M20":
+            self.listings += 1
+            self._reply("Begin file list")
+            for name, size in self.sd_files.items():
+                time.sleep(self.line_latency)
+                self._reply(f"{name} {size}")
+            self._reply("End file list")
+            self._listing = [{"name": x.lstrip("/"), "display": x.rsplit("/", 1)[-1], "size": size}
+                             for x, size in self.sd_files.items()]
+        elif code == "M28" and argument.rsplit("/", 1)[0] in self.missing_directories:
+            self._reply(f"open failed, File: {argument}.")
+        elif code == "M28":
+            self._writing = argument
+            self.sd_files[argument] = 0
+            self._reply(f"Writing to file: {argument}")
+        elif code == "M29":
+            self._writing = None
+            self._reply("Done saving file.")
+        elif code == "M30":
+            if self.sd_files.pop(argument, None) is not None:
+                self._reply(f"File deleted:{argument}")
+            else:
+                self._reply(f"Deletion failed, File: {argument}.")
+        elif code == "M118":
+            self._reply(argument)
+        self._reply("ok")
+
+
+class FakeSettings:
+    """
+    Plugin settings with the global settings the plugin reads, like octoprint.plugin.PluginSettings
+    """
+
+    def __init__(self, defaults: dict, global_values: Optional[dict] = None):
+        self._values = {(key,): value for key, value in defaults.items()}
+        self._global_values = {
+            ("serial", "autoconnect"): True,
+            ("serial", "port"): "AUTO",
+            ("serial", "baudrate"): 0,
+            ("serial", "timeout", "detectionFirst"): 10.0,
+        }
+        self._global_values.update(global_values or dict())
+
+    def get(self, path, *args, **kwargs):
+        return self._values.get(tuple(path))
+
+    def get_boolean(self, path, *args, **kwargs):
+        return bool(self.get(path))
+
+    def get_int(self, path, *args, **kwargs):
+        value = self.get(path)
+        return None if value is None else int(value)
+
+    def get_float(self, path, *args, **kwargs):
+        value = self.get(path)
+        return None if value is None else float(value)
+
+    def set(self, path, value, *args, **kwargs):
+        self._values[tuple(path)] = value
+
+    def global_get(self, path, *args, **kwargs):
+        return self._global_values.get(tuple(path))
+
+    def global_get_boolean(self, path, *args, **kwargs):
+        return bool(self.global_get(path))
+
+    def global_get_int(self, path, *args, **kwargs):
+        return int(self.global_get(path) or 0)
+
+    def global_get_float(self, path, *args, **kwargs):
+        return float(self.global_get(path) or 0)
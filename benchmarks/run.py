@@ -0,0 +1,259 @@
+# coding=utf-8
+"""
+Offline benchmarks of the plugin against synthetic file libraries and a virtual printer.
+
+Run from repository root with OctoPrint installed:
+
+    python -m benchmarks.run --sizes 100 1000 10000 100000 --memory-sizes 50000 --output bench_output.txt
+
+Results are written as JSON, one object with environment and list of results.
+"""
+from __future__ import absolute_import
+
+import argparse
+import gc
+import json
+import logging
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Callable, List
+
+import octoprint.events
+
+from octoprint_autoselect_on_connect import (SYNC_ACTIVE, SYNC_COMPLETE, SYNC_IDLE, SYNC_LAUNCHING,
+                                             AutoConnectAndSelectFilePlugin)
+
+from .fakes import FakeFileManager, FakeSettings, VirtualPrinter
+
+
+def make_plugin(number_of_files: int, data_folder: str, line_latency: float) -> AutoConnectAndSelectFilePlugin:
+    plugin = AutoConnectAndSelectFilePlugin()
+    plugin._identifier = "octoprint_autoselect_on_connect"
+    plugin._plugin_version = "benchmark"
+    plugin._logger = logging.getLogger("benchmark.plugin")
+    plugin._data_folder = data_folder
+    plugin._settings = FakeSettings(plugin.get_settings_defaults())
+    plugin._file_manager = FakeFileManager(number_of_files)
+    plugin._printer = VirtualPrinter(plugin, line_latency)
+    plugin.on_settings_initialized()
+    return plugin
+
+
+def measure(function: Callable[[], object], repeat: int) -> dict:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return {
+        "repeat": repeat,
+        "min": min(timings),
+        "median": statistics.median(timings),
+        "max": max(timings),
+    }
+
+
+def wait_for(condition: Callable[[], bool], timeout: float) -> bool:
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.005)
+    return True
+
+
+def bench_local_files(size: int, data_folder: str, args) -> List[dict]:
+    plugin = make_plugin(size, data_folder, args.latency)
+    results = [
+        dict(name="file_index.cold", size=size, **measure(plugin._rebuild_file_cache, 1)),
+        dict(name="get_latest_local_files", size=size,
+             **measure(lambda: list(plugin.get_latest_local_files(plugin._max_host_files)), args.repeat)),
+    ]
+
+    newest = next(plugin.get_latest_local_files(1))
+    actions = [f"{plugin._action_command} {newest.path}", f"{plugin._action_command} no such file.gcode"]
+
+    def resolve():
+        for action in actions:
+            plugin._printer._printing = False
+            plugin.hook_actioncommands(None, "", action)
+
+    results.append(dict(name="hook_actioncommands", size=size, **measure(resolve, args.repeat)))
+    return results
+
+
+def bench_sync(size: int, data_folder: str, args) -> List[dict]:
+    plugin = make_plugin(size, data_folder, args.latency)
+    printer = plugin._printer
+    results = []
+
+    for name in ("sync.first", "sync.unchanged"):
+        plugin._sync_state = SYNC_LAUNCHING
+        lines_before = printer.lines_received
+        # sync continues in plugin worker, one file at a time
+        timing = measure(lambda: (plugin.sync_sd_with_local(),
+                                  wait_for(lambda: plugin._sync_state != SYNC_ACTIVE, 60)), 1)
+        # wait for listing refresh queued at the end of sync
+        printer.wait_idle()
+        results.append(dict(name=name, size=size, lines=printer.lines_received - lines_before,
+                            sd_files=len(printer.sd_files), **timing))
+    return results
+
+
+def bench_memory(size: int, data_folder: str, args) -> List[dict]:
+    """
+    Python heap used by plugin, synthetic file library of fake file manager is not counted
+    """
+    gc.collect()
+    tracemalloc.start()
+    try:
+        start = tracemalloc.get_traced_memory()[0]
+        library = FakeFileManager(size)
+        library_bytes = tracemalloc.get_traced_memory()[0] - start
+        del library
+
+        gc.collect()
+        start = tracemalloc.get_traced_memory()[0]
+        plugin = make_plugin(size, data_folder, args.latency)
+        created = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        plugin._rebuild_file_cache()
+        index_peak = tracemalloc.get_traced_memory()[1]
+
+        gc.collect()
+        indexed = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        newest = next(plugin.get_latest_local_files(1))
+        list(plugin.get_latest_local_files(plugin._max_host_files))
+        plugin._printer._printing = False
+        plugin.hook_actioncommands(None, "", f"{plugin._action_command} {newest.path}")
+        query_peak = tracemalloc.get_traced_memory()[1]
+
+        gc.collect()
+        steady = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    return [dict(
+        name="memory",
+        size=size,
+        plugin_bytes=created - start - library_bytes,
+        # includes the file listing file manager returns
+        index_peak_bytes=index_peak - created,
+        index_bytes=indexed - created,
+        query_peak_bytes=query_peak - indexed,
+        steady_bytes=steady - start - library_bytes,
+        bytes_per_file=round((indexed - created) / size, 1) if size else None,
+    )]
+
+
+def bench_startup(size: int, data_folder: str, args) -> List[dict]:
+    start = time.perf_counter()
+    plugin = make_plugin(size, data_folder, args.latency)
+    created = time.perf_counter()
+    plugin.on_event(octoprint.events.Events.STARTUP, None)
+    event_done = time.perf_counter()
+    warmed = wait_for(lambda: "startup.warm_index" in plugin._metrics.to_dict()["timings"], 60)
+    metrics = plugin._metrics.to_dict()
+    return [dict(
+        name="startup",
+        size=size,
+        import_seconds=metrics["values"]["startup.import"],
+        init_seconds=metrics["values"]["startup.init"],
+        create_seconds=created - start,
+        event_seconds=event_done - created,
+        warm_index_seconds=metrics["timings"]["startup.warm_index"]["last"] if warmed else None,
+    )]
+
+
+def bench_event_storm(size: int, data_folder: str, args) -> List[dict]:
+    plugin = make_plugin(size, data_folder, args.latency)
+    plugin._sync_scheduler.quiet_time = args.quiet_time
+    plugin._sync_scheduler.max_delay = args.quiet_time * 10
+    file_manager = plugin._file_manager
+    plugin.on_event(octoprint.events.Events.STARTUP, None)
+    wait_for(lambda: plugin._file_cache_valid, 60)  # fake file manager can't be changed while it is listed
+
+    syncs = []
+    sync = plugin.sync_sd_with_local
+
+    def counting_sync():
+        syncs.append(time.perf_counter())
+        sync()
+
+    plugin.sync_sd_with_local = counting_sync
+
+    start = time.perf_counter()
+    for i in range(args.storm):
+        path = f"storm/upload {i:03d}.gcode"
+        file_manager.add(path, 2000000000 + i)
+        plugin.on_event(octoprint.events.Events.FILE_ADDED,
+                        {"storage": "local", "path": path, "name": path.rsplit("/", 1)[-1],
+                         "type": ["machinecode", "gcode"]})
+        time.sleep(args.storm_interval)
+    events_done = time.perf_counter()
+
+    settled = wait_for(lambda: syncs and plugin._sync_state in (SYNC_COMPLETE, SYNC_IDLE)
+                       and not plugin._sync_scheduler.is_pending(), args.quiet_time * 20 + 30)
+    return [dict(
+        name="on_event.storm",
+        size=size,
+        events=args.storm,
+        syncs=len(syncs),
+        merged=plugin._sync_scheduler.total_merged,
+        events_seconds=events_done - start,
+        settled=bool(settled),
+        seconds=(syncs[0] - start) if syncs else None,
+    )]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000, 100000])
+    parser.add_argument("--memory-sizes", type=int, nargs="*", default=[50000],
+                        help="library sizes to measure memory use with")
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--latency", type=float, default=0.002, help="virtual printer seconds per line")
+    parser.add_argument("--storm", type=int, default=50, help="number of events in event storm")
+    parser.add_argument("--storm-interval", type=float, default=0.01, help="seconds between storm events")
+    parser.add_argument("--quiet-time", type=float, default=0.2, help="sync scheduler quiet time")
+    parser.add_argument("--output", help="write JSON here instead of stdout")
+    parser.add_argument("--verbose", action="store_true", help="show plugin logging")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+
+    base_folder = tempfile.mkdtemp(prefix="autoselect_bench_")
+    try:
+        results = []
+        for size in args.sizes:
+            for bench in (bench_startup, bench_local_files, bench_sync, bench_event_storm):
+                data_folder = tempfile.mkdtemp(dir=base_folder)
+                results.extend(bench(size, data_folder, args))
+        for size in args.memory_sizes:
+            results.extend(bench_memory(size, tempfile.mkdtemp(dir=base_folder), args))
+    finally:
+        shutil.rmtree(base_folder, ignore_errors=True)
+
+    report = {
+        "environment": {
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+        },
+        "parameters": vars(args),
+        "results": results,
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "wt", encoding="utf-8") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,20 +1,37 @@
 # coding=utf-8
 from __future__ import absolute_import
 
-import hashlib
-import math
-import pprint
-import re
-import threading
 import time
-from typing import List, Tuple, Optional
 
+_import_started = time.perf_counter()
+
+import collections
+import os
+import threading
+from typing import TYPE_CHECKING, Callable, Deque, Dict, Iterator, List, Set, Tuple, Optional, Union
+
+import flask
 import octoprint.events
-import octoprint.filemanager
 import octoprint.plugin
-from octoprint.filemanager import FileDestinations
-from octoprint.settings import settings
-from octoprint.util import RepeatedTimer
+
+from .connection import CONNECTING_STATES, ConnectionMemory, backoff_delays
+from .file_index import DateOrder, FileRecord
+from .manifest import LinkManifest
+from .metrics import Metrics
+from .selection import (POLICY_NEWEST, POLICY_NEWEST_NOT_PRINTED, POLICY_RECENTLY_SELECTED, SelectionHistory,
+                        SelectionPolicy, create_policy)
+from .scheduler import CoalescingTimer
+from .short_names import MIN_NAME_LENGTH, ShortNameRegistry, short_filename
+from .transfer import SD_DELETE_DONE, SD_WRITE_DONE, SD_WRITE_STARTED, CommandStream, SdWriteTracker
+from .worker import CancelToken, JobWorker
+
+# imported when first needed, link cache and shared index may never be used
+if TYPE_CHECKING:
+    from .link_files import LinkFileCache
+    from .shared_index import SharedFileIndex
+
+# octoprint.filemanager.FileDestinations.LOCAL, file manager is not imported just for this
+LOCAL = "local"
 
 # If you want your plugin to be registered within OctoPrint under a different name than what you defined in setup.py
 # ("OctoPrint-PluginSkeleton"), you may define that here. Same goes for the other metadata derived from setup.py that
@@ -35,6 +52,7 @@ def __plugin_load__():
     __plugin_hooks__ = {
         "octoprint.plugin.softwareupdate.check_config": __plugin_implementation__.get_update_information,
         "octoprint.comm.protocol.action": __plugin_implementation__.hook_actioncommands,
+        "octoprint.comm.protocol.gcode.received": __plugin_implementation__.hook_gcode_received,
     }
 
 
@@ -42,14 +60,77 @@ def filter_machinecode(node):
     return node["type"] == "machinecode"
 
 
+def is_machinecode(path: Optional[str]) -> bool:
+    """
+    Check by file name, upload and move events don't tell file type
+    """
+    if not path:
+        return False
+    # file manager is imported only when a file event needs it
+    from octoprint.filemanager import valid_file_type
+    return valid_file_type(path, type="machinecode")
+
+
+class LazyPretty:
+    """
+    Pretty print object only if log message is actually formatted
+    """
+    __slots__ = ("_obj",)
+    _pp = None
+
+    def __init__(self, obj):
+        self._obj = obj
+
+    def __str__(self):
+        if LazyPretty._pp is None:
+            import pprint
+            LazyPretty._pp = pprint.PrettyPrinter(indent=2, sort_dicts=False)
+        return LazyPretty._pp.pformat(self._obj)
+
+
 SYNC_IDLE = "Idle"
 SYNC_NEEDED = "Needed"
 SYNC_LAUNCHING = "Launching"
 SYNC_ACTIVE = "Active"
 SYNC_COMPLETE = "Complete"
 
+# printer reply when SD card has been initialized, see octoprint.util.comm.MachineCom
+SD_READY_REPLY = "SD card ok"
+
+# SD card directory for "links", sync removes everything else in it
+DEFAULT_HOST_SD_DIRECTORY = "HOST/"
+
+# allowed sync state changes
+SYNC_TRANSITIONS = {
+    SYNC_IDLE: (SYNC_NEEDED,),
+    SYNC_NEEDED: (SYNC_NEEDED, SYNC_LAUNCHING),
+    SYNC_LAUNCHING: (SYNC_ACTIVE, SYNC_NEEDED),
+    SYNC_ACTIVE: (SYNC_COMPLETE, SYNC_IDLE, SYNC_NEEDED),
+    SYNC_COMPLETE: (SYNC_IDLE, SYNC_NEEDED),
+}
+
 
-class AutoConnectAndSelectFilePlugin(octoprint.plugin.EventHandlerPlugin):
+class SyncRun:
+    """
+    Work left in one sync, one unit for each "link" file to delete or write
+    """
+
+    def __init__(self, manifest: LinkManifest):
+        self.manifest = manifest
+        self.wanted: Dict[str, Tuple[str, int]] = {}
+        self.units: Deque[Tuple[Callable[["SyncRun", str], None], str]] = collections.deque()
+        self.files_to_copy = 0
+        self.copied = 0
+        self.sd_changed = False
+        # reason why rest of the sync was given up
+        self.aborted: Optional[str] = None
+        self.started = time.perf_counter()
+
+
+class AutoConnectAndSelectFilePlugin(octoprint.plugin.EventHandlerPlugin,
+                                     octoprint.plugin.SettingsPlugin,
+                                     octoprint.plugin.ShutdownPlugin,
+                                     octoprint.plugin.SimpleApiPlugin):
     """
     TODO
     - bind to files added/deleted/moved event
@@ -67,28 +148,75 @@ class AutoConnectAndSelectFilePlugin(octoprint.plugin.EventHandlerPlugin):
     """
 
     def __init__(self):
-        self.timer = None
-        self._file_cache = {}
+        init_started = time.perf_counter()
+        # connect and sync jobs run one at a time in this worker
+        self._worker = JobWorker("AutoselectOnConnect")
+        self._connect_token = CancelToken()
+        self._sync_token = CancelToken()
+        self._file_cache: Dict[str, FileRecord] = {}
         self._file_cache_mutex = threading.RLock()
-        self._settings = settings()
+        self._file_cache_valid = False
+        # index is rebuilt only in worker, others use the previous one meanwhile
+        self._file_cache_version = 0
+        self._file_cache_rebuild_pending = False
+        # names other than path by which files are looked up, one path or set of paths for each name
+        self._file_lookup: Dict[str, Union[str, set]] = {}
+        self._file_order = DateOrder()
+        # SQLite file shared by instances using the same upload folder, None to keep index in memory only
+        self._shared_index_path: Optional[str] = None
+        self._shared_index: Optional["SharedFileIndex"] = None
+        # opens shared index and orders writes to it, taken before _file_cache_mutex, never in serial comm thread
+        self._shared_index_mutex = threading.RLock()
+        self._selection_policy = SelectionPolicy()
+        self._selection_history: Optional[SelectionHistory] = None
+        # files selected by plugin itself, their FILE_SELECTED events are not user selections
+        self._own_selections: Set[str] = set()
         self._connect_attempt = 0
         self._connect_max_time = 40
-        self._max_connect_attempts = 2
+        self._connect_initial_delay = 2
+        self._connect_delays = iter(())
+        self._connect_target: Optional[Tuple[str, int]] = None
+        self._connection_memory: Optional[ConnectionMemory] = None
 
         self._action_command = "start_file"
-        self._host_sd_directory = "HOST/"
+        self._host_sd_directory = DEFAULT_HOST_SD_DIRECTORY
         self._max_host_files = 5
-        self._waiting_for_sync = False
+        # firmware limits for SD file names, None for no limit
+        self._sd_name_max_length: Optional[int] = None
+        self._sd_dos_names = False
+        self._short_names: Optional[ShortNameRegistry] = None
         self._sync_state = SYNC_IDLE
-        self._max_sync_attempts = 20
-
-        self._pp = pprint.PrettyPrinter(indent=2, sort_dicts=False)
+        self._sync_state_mutex = threading.RLock()
+        self._sync_paused = False
+        # local files or selection changed while sync was running, another one is needed after it
+        self._sync_retrigger = False
+        # SD card readiness is signalled by printer, this is just a fallback
+        self._sd_wait_max_time = 40
+        self._sd_wait_delays = iter(())
+        self._sync_launched: Optional[float] = None
+        # wait for file event storms to calm down before syncing, but not forever
+        self._sync_quiet_time = 5
+        self._sync_max_delay = 30
+        self._sd_write_timeout = 10  # per file
+        self._link_manifest: Optional[LinkManifest] = None
+        self._max_link_repairs = 2  # per "link" until it has been verified
+        self._manifest_max_age = 24 * 60 * 60  # list SD files at least daily
+        self._link_cache: Optional["LinkFileCache"] = None
+        self._sd_write_tracker = SdWriteTracker()
+        self._command_stream = CommandStream(lambda commands: self._printer.commands(commands))
+        self._sync_scheduler = CoalescingTimer(self._sync_quiet_time, self._sync_max_delay, self._launch_sync,
+                                               schedule=self._worker.schedule)
+
+        self._metrics = Metrics()
+        self._connect_started: Optional[float] = None
+        self._metrics.set("startup.import", _import_time)
+        self._metrics.set("startup.init", time.perf_counter() - init_started)
 
     def hook_actioncommands(self, comm, line, action, *args, **kwargs):
         """
         Handle //action:<self._action_command> <file> to start printing local file <file>
         """
-        self._logger.info(f"Command received: '{action}' with params {args}")
+        self._logger.info("Command received: '%s' with params %s", action, args)
 
         # it seems that line and args are empty, and everything is packed in action?
         candidate = action.strip()
@@ -97,44 +225,33 @@ class AutoConnectAndSelectFilePlugin(octoprint.plugin.EventHandlerPlugin):
 
         file_name = candidate[len(self._action_command):].strip()
 
-        files = self.get_latest_local_files(None)
-        is_started = False
-        if files:
-            for file in files:
-                _, path, _, _ = file
-                # local path is not important,
-                # though if there are files with same names in multiple directories,
-                # we can't be sure *which* will be printed.
-                # Starting from newest should help :)
-                if file_name in path:
-                    # select that file and start printing
-                    self._logger.info(f"Selecting and starting {path}")
-                    self._printer.select_file(path, False, False)
-                    self._logger.info(f"STARTING PRINT '{file_name}' :)")
-                    self._printer.start_print()
-                    is_started = True
-
-        if not is_started:
-            self._logger.info(f"Did not find '{file_name}' to print :/")
-
-        # # get all local gcode files
-        # files = self._file_manager.list_files(FileDestinations.LOCAL, filter=filter_machinecode, recursive=True)
-        # files = files["local"] if "local" in files else dict()
-        #
-        # if files:
-        #     for key in files:
-        #         file = files[key]
-        #         path = file["path"]
-        #         # local path is not important,
-        #         # though if there are files with same names in multiple directories,
-        #         # we can't be sure *which* will be printed
-        #         if file_name in path:
-        #             # select that file and start printing
-        #             self._logger.info(f"Selecting and starting {path}")
-        #             self._printer.select_file(path, False, False)
-        #             self._printer.start_print()
-        # else:
-        #     self._logger.info(f"Did not find '{file_name}' to print :/")
+        # local path is not important,
+        # though if there are files with same names in multiple directories,
+        # we can't be sure *which* will be printed.
+        # Starting from newest should help :)
+        with self._metrics.span("action.lookup"):
+            path = self._lookup_local_file(file_name)
+        if path is not None:
+            # select that file and start printing
+            self._logger.info("Selecting and starting %s", path)
+            self._select_file(path)
+            self._logger.info("STARTING PRINT '%s' :)", file_name)
+            self._sync_paused = True  # don't start writing next "link" file
+            self._printer.start_print()
+            self._metrics.increment("action.started")
+        else:
+            self._logger.info("Did not find '%s' to print :/", file_name)
+            self._metrics.increment("action.not_found")
+
+    def hook_gcode_received(self, comm, line, *args, **kwargs):
+        """
+        Follow printer replies to confirm SD writes
+        """
+        self._sd_write_tracker.feed(line)
+        if SD_READY_REPLY in line and self._sync_state == SYNC_LAUNCHING:
+            # OctoPrint handles the line after this hook, give it a moment
+            self._on_sd_ready("printer", delay=0.2)
+        return line
 
     def sync_sd_with_local(self):
         """
@@ -144,91 +261,367 @@ class AutoConnectAndSelectFilePlugin(octoprint.plugin.EventHandlerPlugin):
         "Links" contain M118 command to launch host printing using hook_actioncommands
         """
         if not self._printer.is_operational() or self._printer.is_printing():
+            self._move_to_state(SYNC_NEEDED, message="Printer is busy", expected=(SYNC_LAUNCHING,))
+            return
+        with self._sync_state_mutex:
+            if not self._move_to_state(SYNC_ACTIVE, message="Activating sync", expected=(SYNC_LAUNCHING,)):
+                self._logger.info("Trying to sync when '%s'", self._sync_state)
+                return
+            # changes so far are seen by this sync
+            self._sync_retrigger = False
+        manifest = self._get_link_manifest()
+        run = SyncRun(manifest)
+        try:
+            # get latest local gcode files, keyed by name of their "link"
+            self._refresh_file_cache()
+            newest_host_files = self.get_ranked_local_files(self._max_host_files)
+            short_names = self._get_short_names()
+            run.wanted = {short_names.assign(x.path, x.name): (x.path, x.date) for x in newest_host_files}
+
+            # printer SD listing is read over serial only when manifest can't be trusted,
+            # otherwise the listing OctoPrint already has is good enough to verify against
+            # "links" in previous host directory are not listed anymore, they are deleted by their SD names
+            manifest.change_directory(self._host_sd_directory)
+            refresh = manifest.is_stale(self._manifest_max_age)
+            printer_host_files = self._list_printer_host_files(refresh)
+            if not refresh and any(x not in printer_host_files for x in manifest.entries):
+                # listing disagrees with manifest, read it again before trusting either
+                refresh = True
+                printer_host_files = self._list_printer_host_files(True)
+            manifest.reconcile(printer_host_files, verified=refresh)
+
+            # compare, manifest is updated after every file so an interrupted sync continues from where it was
+            host_files_to_delete, host_files_to_copy = manifest.diff(run.wanted)
+        except Exception:
+            self._logger.exception("Could not compare host files")
+            self._finish_sync(run)
+            return
+
+        if not manifest.retired and not host_files_to_delete and not host_files_to_copy:
+            self._logger.info("Host files were OK")
+            self._finish_sync(run)
+            return
+
+        self._logger.info("deleting old host files from sd: ----------------\n%s",
+                          LazyPretty(host_files_to_delete))
+        self._logger.info("copying new host files to sd: -------------------\n%s",
+                          LazyPretty(host_files_to_copy))
+        if manifest.retired:
+            self._logger.info("deleting host files from previous directory: ---\n%s",
+                              LazyPretty(manifest.retired))
+        run.units.extend((self._delete_retired_link, x) for x in list(manifest.retired))
+        run.units.extend((self._delete_link, x) for x in host_files_to_delete)
+        run.units.extend((self._write_link, x) for x in host_files_to_copy)
+        run.files_to_copy = len(host_files_to_copy)
+
+        self._command_stream.reset_stats()
+        self._command_stream.send([f"M117 Updating host files"])
+        token = self._sync_token = CancelToken()
+        self._worker.submit(lambda: self._run_sync_unit(run, token), token)
+
+    def _run_sync_unit(self, run: "SyncRun", token: CancelToken):
+        """
+        Delete or write one "link" file, then let other jobs run before the next one
+        """
+        if self._sync_paused or self._printer.is_printing() or not self._printer.is_operational():
+            self._logger.info("Pausing sync with %d files to go", len(run.units))
+            self._metrics.increment("sync.paused")
+            self._finish_sync(run, paused=True)
             return
-        if self._sync_state != SYNC_LAUNCHING:
-            self._logger.info(f"Trying to sync when '{self._sync_state}'")
+        if not run.units:
+            if run.aborted:
+                self._command_stream.send([f"M117 Host files not updated: {run.aborted}"])
+            elif run.files_to_copy:
+                self._command_stream.send([f"M117 {run.copied}/{run.files_to_copy} host files updated"])
+            else:
+                self._command_stream.send([f"M117 Host files updated"])
+            self._finish_sync(run)
             return
-        self._move_to_state(SYNC_ACTIVE, message="Activating sync")
-        self._printer.commands([f"M117 Updating host files"])
+
+        unit, short_name = run.units.popleft()
+        run.sd_changed = True
         try:
-            # get all printer SD files
-            printer_files = self._printer.get_sd_files(refresh=True)
-            printer_host_files = [x for x in printer_files if x["name"].startswith(self._host_sd_directory)]
-
-            # get latest local gcode files
-            newest_host_files = self.get_latest_local_files(self._max_host_files)
-
-            # compare
-            names_of_newest_host_files = [x[2] for x in newest_host_files]
-            printer_host_files_to_delete = [x for x in printer_host_files if
-                                            x["display"] not in names_of_newest_host_files]
-            self._logger.info(
-                f"deleting old host files from sd: ----------------\n{self._pp.pformat([x['name'] for x in printer_host_files_to_delete])}")
-            for f in printer_host_files_to_delete:
-                self._printer.delete_sd_file(f["name"])
-
-            printer_host_files = [x for x in printer_host_files if x not in printer_host_files_to_delete]
-            names_of_printer_host_files = [x["display"] for x in printer_host_files]
-
-            # self._logger.info(
-            #     f"Newest local files are ------------------\n{self._pp.pformat([x[2] for x in newest_host_files])}")
-            # self._logger.info(
-            #     f"Remaining SD files are ------------------\n{self._pp.pformat(names_of_printer_host_files)}")
-
-            host_files_to_copy = [x for x in newest_host_files if x[2] not in names_of_printer_host_files]
-            self._logger.info(
-                f"copying new host files to sd: -------------------\n{self._pp.pformat([x[2] for x in host_files_to_copy])}")
+            unit(run, short_name)
+        except Exception:
+            run.manifest.stale = True
+            self._metrics.increment("sync.unit_failed")
+            self._logger.exception("Updating /%s%s failed", self._host_sd_directory, short_name)
+        self._save_link_manifest()
+
+        if not token.cancelled:
+            self._worker.submit(lambda: self._run_sync_unit(run, token), token)
+        else:
+            self._finish_sync(run, paused=True)
+
+    def _delete_link(self, run: "SyncRun", short_name: str):
+        manifest = run.manifest
+        sd_name = manifest.entries[short_name].get("sd_name") or f"{self._host_sd_directory}{short_name}"
+        deleted = self._delete_sd_file(sd_name)
+        manifest.remove(short_name)
+        if not deleted:
+            # SD content is unknown, verify from listing next time
+            manifest.stale = True
+
+    def _delete_retired_link(self, run: "SyncRun", sd_name: str):
+        """
+        Delete "link" left in previous host directory, it is not retried since that directory is not listed
+        """
+        self._delete_sd_file(sd_name)
+        run.manifest.retired.remove(sd_name)
+
+    def _delete_sd_file(self, sd_name: str) -> bool:
+        self._logger.info("deleting file: /%s", sd_name)
+        self._sd_write_tracker.begin(sd_name, SD_DELETE_DONE)
+        self._command_stream.send([f"M30 /{sd_name}"])
+        with self._metrics.span("sync.delete"):
+            deleted = self._sd_write_tracker.wait(self._sd_write_timeout)
+        if not deleted:
+            self._metrics.increment("sync.delete_failed")
+            self._logger.warning("Printer did not confirm deleting /%s", sd_name)
+        return deleted
+
+    def _write_link(self, run: "SyncRun", short_name: str):
+        manifest = run.manifest
+        path, date = run.wanted[short_name]
+        self._logger.info("writing file: /%s%s", self._host_sd_directory, short_name)
+
+        # one file at a time, next one is sent when printer has confirmed the previous one
+        from .link_files import link_checksum, link_sizes
+        lines = self._get_link_content(path)
+        with self._metrics.span("sync.copy_file"):
+            # printer that is not writing runs the lines, M118 of the "link" would start a print.
+            # so contents are sent only after printer has confirmed the file is open
+            self._sd_write_tracker.begin(short_name, SD_WRITE_STARTED)
+            self._command_stream.send([f"M28 /{self._host_sd_directory}{short_name}"])
+            result = opened = self._sd_write_tracker.wait(self._sd_write_timeout)
+            if opened:
+                self._sd_write_tracker.begin(short_name, SD_WRITE_DONE)
+                self._command_stream.send([*lines, "M29"])
+                result = self._sd_write_tracker.wait(self._sd_write_timeout)
+            elif opened is None:
+                self._command_stream.send(["M29"])  # in case file was opened after all
+        if result:
+            run.copied += 1
+            manifest.add(short_name, path, date, link_checksum(lines), link_sizes(lines))
+        else:
+            # SD content is unknown, verify from listing next time
+            manifest.stale = True
+            if result is None:
+                self._metrics.increment("sync.copy_timeout")
+                self._logger.warning("Printer did not confirm /%s%s in %s seconds",
+                                     self._host_sd_directory, short_name, self._sd_write_timeout)
+            else:
+                self._metrics.increment("sync.copy_failed")
+                self._logger.warning("Printer failed to write /%s%s", self._host_sd_directory, short_name)
+            if opened is False:
+                # other files can't be written either
+                run.units.clear()
+                run.aborted = f"can't write to /{self._host_sd_directory}"
+                self._metrics.increment("sync.aborted")
+                self._logger.error("Printer could not open /%s%s, does directory /%s exist on SD card? "
+                                   "Giving up this sync", self._host_sd_directory, short_name,
+                                   self._host_sd_directory)
+
+    def _finish_sync(self, run: "SyncRun", paused: bool = False):
+        self._metrics.observe("sync", time.perf_counter() - run.started)
+        if run.sd_changed:
+            self._logger.info("Sync sent %d lines, %d bytes", self._command_stream.lines_sent,
+                              self._command_stream.bytes_sent)
+            self._metrics.increment("sync.lines_sent", self._command_stream.lines_sent)
+            self._metrics.increment("sync.bytes_sent", self._command_stream.bytes_sent)
+        self._save_link_manifest()
+        self._save_short_names(run.manifest)
+        self._prune_link_cache()
+
+        if paused:
+            # continues with a new diff when printing is done
+            self._move_to_state(SYNC_NEEDED, message="Sync paused", expected=(SYNC_ACTIVE,))
+        elif run.sd_changed:
+            # SD file list update moves to idle
+            self._move_to_state(SYNC_COMPLETE, message="Completed sync", expected=(SYNC_ACTIVE,))
+        elif self._move_to_state(SYNC_IDLE, message="Nothing to sync", expected=(SYNC_ACTIVE,)):
+            if not self._retrigger_sync():
+                self._worker.submit(self._verify_links)
+        if run.sd_changed:
+            self._printer.refresh_sd_files()
+
+    def _list_printer_host_files(self, refresh: bool) -> dict:
+        with self._metrics.span("sync.sd_listing.refresh" if refresh else "sync.sd_listing"):
+            return self._printer_host_files(self._printer.get_sd_files(refresh=refresh))
+
+    def _printer_host_files(self, printer_files: Optional[List[dict]]) -> dict:
+        """
+        Files in printer SD host directory as short (long) name -> printer name
+        """
+        return {short_name: name for short_name, name, _ in self._iter_printer_host_files(printer_files)}
 
-            try:
-                commands = []
-                for file in host_files_to_copy:
-                    _, path, _, name = file
-                    short_name = self._short_filename(name)
-                    commands.append(f"M28 /{self._host_sd_directory}{short_name}")
-                    self._logger.info(f"writing file: /{self._host_sd_directory}{short_name}")
-
-                    commands.extend([
-                        f"M117 Starting host print...",
-                        f"M118 A1 action: {self._action_command} {path}",
-                        f"M29"
-                    ])
-
-                if commands:
-                    self._printer.commands(commands)
-                    self._logger.info("Waiting for commands to run")
-                    time.sleep(10)
-                    self._printer.commands([f"M117 {len(host_files_to_copy)} host files updated"])
-                else:
-                    self._printer.commands([f"M117 Host files were OK"])
-            except:
-                pass
+    def _printer_host_file_sizes(self, printer_files: Optional[List[dict]]) -> Dict[str, Optional[int]]:
+        """
+        Files in printer SD host directory as short (long) name -> size, None if printer did not tell it
+        """
+        return {short_name: size for short_name, _, size in self._iter_printer_host_files(printer_files)}
+
+    def _iter_printer_host_files(self, printer_files: Optional[List[dict]]) -> Iterator[Tuple[str, str, Optional[int]]]:
+        for x in printer_files or []:
+            name = x["name"][1:] if x["name"].startswith("/") else x["name"]
+            if not name.startswith(self._host_sd_directory):
+                continue
+            display = x.get("display") or name
+            short_name = display.rsplit("/", 1)[-1].lower()
+            yield short_name, name, x.get("size")
+
+    def _save_short_names(self, manifest: LinkManifest):
+        try:
+            short_names = self._get_short_names()
+            short_names.retain(x["path"] for x in manifest.entries.values() if x["path"] is not None)
+            if short_names.changed:
+                short_names.save()
+        except Exception:
+            self._logger.exception("Could not save SD link names")
+
+    def _get_link_manifest(self) -> LinkManifest:
+        if self._link_manifest is None:
+            self._link_manifest = LinkManifest(os.path.join(self.get_plugin_data_folder(), "sd_links.json"))
+            self._link_manifest.load()
+        return self._link_manifest
+
+    def _save_link_manifest(self):
+        try:
+            self._get_link_manifest().save()
+        except Exception:
+            self._logger.exception("Could not save SD link manifest")
 
-        finally:
-            # self._printer.commands(["M117 Host files updated"])
-            self._move_to_state(SYNC_COMPLETE, message="Completed sync")
+    def _short_filename(self, original_name: str, salt: str = "") -> str:
+        """
+        Create unique(ish) short-ish file names without knowing names of other files, see _get_short_names
+        """
+        return short_filename(original_name, self._sd_name_max_length, self._sd_dos_names, salt)
 
-    def _short_filename(self, original_name):
+    def _get_short_names(self) -> ShortNameRegistry:
         """
-        Create unique(ish) short-ish file names without knowing names of other files
+        Registry of names of files that have "links" in SD, resolves collisions of short names
         """
-        base = re.sub(r'\.gcode$', '', original_name.lower())
-        base = re.sub(r'[^a-z0-9]+', '_', base)  # Keep alphanum + underscore
-        base = base.strip('_')
+        if self._short_names is None:
+            name_format = f"{self._sd_name_max_length}/{'8.3' if self._sd_dos_names else 'long'}"
+            self._short_names = ShortNameRegistry(os.path.join(self.get_plugin_data_folder(), "short_names.json"),
+                                                  name_format, self._short_filename)
+            self._short_names.load()
+        return self._short_names
 
-        # Hash the base name
-        hash_part = hashlib.sha1(base.encode()).hexdigest()[:6]
+    ##~~ Link verification
 
-        # Use first 8 chars of the cleaned name as prefix
-        prefix = base[:12].strip('_')
+    def _verify_links(self):
+        """
+        Compare "links" in SD file list OctoPrint already has to what was written,
+        and mark the ones that don't match to be written again by next sync
+        """
+        if self._sync_state != SYNC_IDLE or not self._is_ready_for_sync():
+            return
+        from .link_files import link_checksum
+        manifest = self._get_link_manifest()
+        repairs = 0
+        with self._metrics.span("verify"):
+            sizes = self._printer_host_file_sizes(self._printer.get_sd_files())
+            for short_name, entry in list(manifest.entries.items()):
+                if entry["path"] is None:
+                    continue  # unknown file, deleted by sync anyway
+                self._metrics.increment("verify.checked")
+                size = sizes.get(short_name)
+                try:
+                    if short_name not in sizes:
+                        problem = "missing"
+                    elif entry.get("checksum") != link_checksum(self._get_link_content(entry["path"])):
+                        problem = "content"
+                    elif size is not None and entry.get("sizes") and size not in entry["sizes"]:
+                        problem = "size"
+                    else:
+                        manifest.mark_verified(short_name)
+                        continue
+                except Exception:
+                    self._metrics.increment("verify.failed")
+                    self._logger.exception("Could not verify /%s%s", self._host_sd_directory, short_name)
+                    continue
+
+                self._metrics.increment(f"verify.mismatch.{problem}")
+                if entry.get("repairs", 0) >= self._max_link_repairs:
+                    # rewriting did not help, firmware probably stores the file differently
+                    self._metrics.increment("verify.unrepairable")
+                    self._logger.warning("/%s%s still does not match (%s) after %d repairs",
+                                         self._host_sd_directory, short_name, problem, entry["repairs"])
+                    continue
+                self._logger.info("/%s%s does not match (%s), writing it again",
+                                  self._host_sd_directory, short_name, problem)
+                manifest.mark_for_repair(short_name)
+                repairs += 1
+        self._save_link_manifest()
+
+        if repairs:
+            self._metrics.increment("verify.repairs", repairs)
+            if self._is_ready_for_sync():
+                self._move_to_state(SYNC_NEEDED, start_sync=True, message="Repairing links", expected=(SYNC_IDLE,))
+
+    ##~~ Link file contents
+
+    def _get_link_cache(self) -> "LinkFileCache":
+        if self._link_cache is None:
+            from .link_files import LinkFileCache
+            self._link_cache = LinkFileCache(os.path.join(self.get_plugin_data_folder(), "links"))
+        return self._link_cache
+
+    def _get_link_content(self, path: str) -> List[str]:
+        """
+        Commands of "link" file for local file path, rendered when file was added or now if not cached.
+        Plain link without metadata if local file can't be read.
+        """
+        from .link_files import read_gcode_metadata, render_link
+        try:
+            disk_path = self._file_manager.path_on_disk(LOCAL, path)
+            stat = os.stat(disk_path)
+            link_cache = self._get_link_cache()
+            key = link_cache.key(path, stat.st_mtime, stat.st_size, self._action_command)
+            lines = link_cache.get(key)
+            if lines is not None:
+                self._metrics.increment("link_cache.hit")
+                return lines
+            self._metrics.increment("link_cache.miss")
+            with self._metrics.span("link_cache.render"):
+                lines = render_link(self._action_command, path, read_gcode_metadata(disk_path))
+            link_cache.put(key, lines)
+            return lines
+        except OSError as e:
+            self._logger.debug("Could not render link for %s: %s", path, e)
+        except Exception:
+            self._logger.exception("Could not render link for %s", path)
+        self._metrics.increment("link_cache.failed")
+        return render_link(self._action_command, path, None)
+
+    def _prerender_link(self, payload: Optional[dict]):
+        """
+        Render "link" file of uploaded gcode file, so sync only has to send it
+        """
+        if payload is None or payload.get("storage", payload.get("target")) != LOCAL:
+            return
+        path = payload["path"]
+        if not is_machinecode(path):
+            return
+        self._worker.submit(lambda: self._get_link_content(path))
 
-        return f"{prefix}_{hash_part}.gcode"
+    def _prune_link_cache(self):
+        try:
+            self._get_link_cache().prune()
+        except Exception:
+            self._logger.exception("Could not prune link cache")
 
     def on_event(self, event, payload):
-        # self._logger.info(f"Event '{event}' has payload {self._pp.pformat(payload)}")
+        # self._logger.info(f"Event '{event}' has payload {LazyPretty(payload)}")
         # self._logger.info(f"Printer is operational: {self._printer.is_operational()}\nPrinter SD is ready: {self._printer.is_sd_ready()}\nPrinter is printing: {self._printer.is_printing()}")
         # self._logger.info(f"Sync state is '{self._sync_state}'")
-        if event == octoprint.events.Events.CONNECTIONS_AUTOREFRESHED:
-            if not self._settings.getBoolean(["serial", "autoconnect"]):
+        if event == octoprint.events.Events.STARTUP:
+            # build local file index once in background, later changes are applied as deltas
+            self._worker.submit(self._warm_file_cache)
+
+        elif event == octoprint.events.Events.CONNECTIONS_AUTOREFRESHED:
+            if not self._settings.global_get_boolean(["serial", "autoconnect"]):
                 self._logger.info("Autoconnect on startup is not configured")
                 return
 
@@ -239,36 +632,19 @@ class AutoConnectAndSelectFilePlugin(octoprint.plugin.EventHandlerPlugin):
 
             try:
                 (port, baudrate) = (
-                    self._settings.get(["serial", "port"]),
-                    self._settings.getInt(["serial", "baudrate"]),
+                    self._settings.global_get(["serial", "port"]),
+                    self._settings.global_get_int(["serial", "baudrate"]),
                 )
                 connection_options = self._printer.get_connection_options()
                 if new_ports and (
                     (port in connection_options["ports"] and port in new_ports) or port == "AUTO"):
-                    self._logger.info(f"Trying to connect to configured serial port {port}")
-
-                    def condition():
-                        return self._connect_attempt <= self._max_connect_attempts
-
-                    def try_connect():
-                        self._logger.info(
-                            f"Connection attempt {self._connect_attempt + 1}/{self._max_connect_attempts}")
-                        if not self._printer.is_operational():
-                            self._printer.connect()
-                        self._connect_attempt += 1
-
-                    period = self._settings.getFloat(["serial", "timeout", "detectionFirst"])
-                    # reserve long enough time to wait for connection
-                    self._max_connect_attempts = math.ceil(self._connect_max_time / period)
-                    self._connect_attempt = 0
-
-                    self._logger.info(f"Try connection for {self._max_connect_attempts} x {period} seconds")
-                    self.timer = RepeatedTimer(period, try_connect, run_first=False, condition=condition)
-                    self.timer.start()
+                    self._logger.info("Trying to connect to configured serial port %s", port)
+                    self._start_connecting(port, new_ports)
 
                 else:
                     self._logger.info(
-                        f"Could not find configured serial port {port} in the system, cannot automatically connect to a non existing printer. Is it plugged in and booted up yet?"
+                        "Could not find configured serial port %s in the system, cannot automatically connect to a non existing printer. Is it plugged in and booted up yet?",
+                        port
                     )
             except Exception:
                 self._logger.exception(
@@ -276,125 +652,747 @@ class AutoConnectAndSelectFilePlugin(octoprint.plugin.EventHandlerPlugin):
                 )
 
         elif event == octoprint.events.Events.CONNECTED:
-            if self.timer is not None:
-                self.timer.cancel()  # connected, don't try again :)
-                self.timer = None
-            self._move_to_state(SYNC_NEEDED, start_sync=True, message="Connected")
-
-            # get all local gcode files
-            files = self._file_manager.list_files(FileDestinations.LOCAL, filter=filter_machinecode, recursive=True)
-            files = files["local"] if "local" in files else dict()
-
-            # extract dates and paths, other attributes not needed
-            if files:
-                date_files: List[Tuple] = []
-                for key in files:
-                    file = files[key]
-                    if "gcode" in file["typePath"]:  # filter out directories
-                        date = file["date"]
-                        path = file["path"]
-                        date_files.append((date, path))
-
-                # sort files to latest (youngest) first
-                # self._logger.info("Local files before sorting:\n{}".format(date_files))
-                date_files.sort(reverse=True, key=lambda f: f[0])
-                # self._logger.info("Local files after sorting:\n{}".format(date_files))
-
-                # at this time only top 1 interests us ;)
-                date, path = date_files[0]
-
-                # select that file
-                self._logger.info("Selecting {} on {} that was just uploaded".format(path, FileDestinations.LOCAL))
-                self._printer.select_file(path, False, False)
-            else:
-                self._logger.info("No local files to select from")
-
-        elif event == octoprint.events.Events.PRINT_DONE:
+            self._connect_token.cancel()  # connected, don't try again :)
+            self._sync_token.cancel()  # sync of previous connection, if any
+            self._sync_scheduler.cancel()
+            self._remember_connection(payload)
+            if self._connect_started is not None:
+                self._metrics.observe("connect", time.perf_counter() - self._connect_started)
+                self._connect_started = None
+            if self._move_to_state(SYNC_NEEDED, message="Connected"):
+                # no other triggers to wait for, start waiting for SD card right away
+                self._start_sync(quiet_time=0)
+
+            # local file index may need rebuilding, which is done in worker
+            self._worker.submit(self._select_on_connect)
+
+        elif event == octoprint.events.Events.PRINT_STARTED:
+            self._sync_paused = True
+
+        elif event in (octoprint.events.Events.PRINT_DONE, octoprint.events.Events.PRINT_FAILED):
+            self._sync_paused = False
+            # printed file may drop out of "links" depending on selection policy
+            history_changed = (event == octoprint.events.Events.PRINT_DONE
+                               and self._update_selection_history(payload, printed=True))
             self._logger.info("Print finished, checking is file sync should and can be done")
-            if self._sync_state == SYNC_NEEDED and self._printer.is_operational() and self._printer.is_sd_ready() and not self._printer.is_printing():
-                self._move_to_state(SYNC_NEEDED, start_sync=True, message="after print done")
+            if history_changed:
+                self._request_sync("after print done")
+            elif self._is_ready_for_sync():
+                self._move_to_state(SYNC_NEEDED, start_sync=True, message="after print done",
+                                    expected=(SYNC_NEEDED,))
+
+        elif event == octoprint.events.Events.FILE_SELECTED:
+            if payload is not None and payload.get("path") in self._own_selections:
+                self._own_selections.discard(payload["path"])  # selected by plugin, not by user
+            elif self._update_selection_history(payload, printed=False):
+                self._request_sync("after file selected")
 
         elif event == octoprint.events.Events.UPDATED_FILES:
             # this may originate from changes from local files or from reading SD card file list
-            if self._sync_state == SYNC_COMPLETE:
-                # updating SD content after sync
-                self._move_to_state(SYNC_IDLE, message="Sync has been completed")
+            if self._move_to_state(SYNC_IDLE, message="Sync has been completed", expected=(SYNC_COMPLETE,)):
+                # SD file list has been read after sync, check what was written.
+                # sync that missed changes verifies when it is done
+                if not self._retrigger_sync():
+                    self._worker.submit(self._verify_links)
+
+            elif self._sync_state == SYNC_LAUNCHING:
+                # SD card file list was read, so it is ready
+                self._on_sd_ready("files")
 
-            elif (
-                self._sync_state == SYNC_IDLE or self._sync_state == SYNC_NEEDED) and self._printer.is_operational() and self._printer.is_sd_ready() and not self._printer.is_printing():
-                self._move_to_state(SYNC_NEEDED, start_sync=True, message="after update")
+            elif self._is_ready_for_sync():
+                self._move_to_state(SYNC_NEEDED, start_sync=True, message="after update",
+                                    expected=(SYNC_IDLE, SYNC_NEEDED))
 
-            elif self._sync_state == SYNC_IDLE:
-                self._move_to_state(SYNC_NEEDED, message="after update")
+            else:
+                self._move_to_state(SYNC_NEEDED, message="after update", expected=(SYNC_IDLE,))
 
         elif event == octoprint.events.Events.UPLOAD or event == octoprint.events.Events.FILE_ADDED or event == octoprint.events.Events.FILE_REMOVED or event == octoprint.events.Events.FILE_MOVED:
-            if (
-                self._sync_state == SYNC_IDLE or self._sync_state == SYNC_NEEDED) and self._printer.is_operational() and self._printer.is_sd_ready() and not self._printer.is_printing():
-                self._move_to_state(SYNC_NEEDED, start_sync=True, message="after upload/add/remove")
-
-            elif self._sync_state == SYNC_IDLE:
-                self._move_to_state(SYNC_NEEDED, message="after upload/add/remove")
-
-    def _move_to_state(self, new_state: str, start_sync: bool = False, message: str = ""):
-        self._logger.info(f"{self._sync_state} -> {new_state} {'START' if start_sync else ''} : {message}")
-        self._sync_state = new_state
-        if start_sync:
-            self._start_sync()
-
-    def _start_sync(self):
-        if self._sync_state != SYNC_NEEDED:
-            self._logger.info(f"Sync state is '{self._sync_state}' - not starting")
+            if not self._is_local_gcode_event(payload):
+                return  # models and other files don't change "links"
+            if event != octoprint.events.Events.UPLOAD:
+                # FILE_ADDED follows every upload, it is enough to index and render the file once
+                self._apply_file_event(event, payload)
+            if event == octoprint.events.Events.FILE_REMOVED:
+                self._forget_selection_history(payload.get("path"))
+            if event == octoprint.events.Events.FILE_ADDED:
+                self._prerender_link(payload)
+            self._request_sync("after upload/add/remove")
+
+        elif event in (octoprint.events.Events.FOLDER_ADDED, octoprint.events.Events.FOLDER_REMOVED,
+                       octoprint.events.Events.FOLDER_MOVED):
+            # folder changes may touch any number of files, let next access rescan
+            self._invalidate_file_cache(f"{event}")
+
+    ##~~ Connecting
+
+    def _start_connecting(self, port: str, new_ports: List[str]):
+        """
+        Try to connect with growing intervals, starting with last port and baudrate that worked
+        """
+        self._connect_token.cancel()  # restart previous attempts
+        self._connect_token = CancelToken()
+
+        remembered = self._get_connection_memory().get(port)
+        if remembered is not None and remembered[0] in new_ports:
+            self._connect_target = remembered
+        else:
+            self._connect_target = None
+
+        # wait at most one detection timeout between attempts
+        period = self._settings.global_get_float(["serial", "timeout", "detectionFirst"]) or 0
+        self._connect_delays = backoff_delays(self._connect_initial_delay, period, self._connect_max_time)
+        self._connect_attempt = 0
+        self._connect_started = time.perf_counter()
+
+        self._logger.info("Try connection for %s seconds, at most %s seconds apart", self._connect_max_time, period)
+        self._schedule_connect_attempt(self._connect_token)
+
+    def _schedule_connect_attempt(self, token: CancelToken):
+        delay = next(self._connect_delays, None)
+        if delay is None:
+            if not self._printer.is_operational():
+                self._logger.info("Could not connect in %d attempts", self._connect_attempt)
+                self._metrics.increment("connect.gave_up")
+            return
+        self._worker.schedule(delay, lambda: self._try_connect(token), token)
+
+    def _try_connect(self, token: CancelToken):
+        if self._printer.is_operational():
+            return
+        if self._printer.get_state_id() in CONNECTING_STATES:
+            # don't interrupt port or baudrate detection that is already running
+            self._logger.info("Connection is in progress, skipping attempt")
+            self._metrics.increment("connect.skipped")
+        else:
+            self._connect_attempt += 1
+            self._metrics.increment("connect.attempts")
+            with self._metrics.span("connect.attempt"):
+                if self._connect_attempt == 1 and self._connect_target is not None:
+                    port, baudrate = self._connect_target
+                    self._logger.info("Connection attempt %d to last known %s @ %s", self._connect_attempt, port,
+                                      baudrate)
+                    self._printer.connect(port=port, baudrate=baudrate)
+                else:
+                    self._logger.info("Connection attempt %d", self._connect_attempt)
+                    self._printer.connect()
+        if not token.cancelled:
+            self._schedule_connect_attempt(token)
+
+    def _remember_connection(self, payload: Optional[dict]):
+        if not payload or not payload.get("port") or not payload.get("baudrate"):
+            return
+        try:
+            memory = self._get_connection_memory()
+            if memory.remember(self._settings.global_get(["serial", "port"]), payload["port"], payload["baudrate"]):
+                memory.save()
+        except Exception:
+            self._logger.exception("Could not save connection details")
+
+    def _get_connection_memory(self) -> ConnectionMemory:
+        if self._connection_memory is None:
+            self._connection_memory = ConnectionMemory(os.path.join(self.get_plugin_data_folder(), "connections.json"))
+            self._connection_memory.load()
+        return self._connection_memory
+
+    def _is_ready_for_sync(self) -> bool:
+        return self._printer.is_operational() and self._printer.is_sd_ready() and not self._printer.is_printing()
+
+    def _move_to_state(self, new_state: str, start_sync: bool = False, message: str = "",
+                       expected: Optional[Tuple[str, ...]] = None) -> bool:
+        """
+        Change sync state if current state is one of expected (any if None) and the change is allowed.
+        Returns False if state was not changed.
+        """
+        with self._sync_state_mutex:
+            old_state = self._sync_state
+            if expected is not None and old_state not in expected:
+                return False
+            if new_state not in SYNC_TRANSITIONS[old_state] and new_state != old_state:
+                self._logger.warning("Sync state can't change %s -> %s : %s", old_state, new_state, message)
+                return False
+            self._logger.info("%s -> %s %s : %s", old_state, new_state, "START" if start_sync else "", message)
+            self._metrics.increment(f"state.{old_state}->{new_state}")
+            self._sync_state = new_state
+            if start_sync:
+                self._start_sync()
+            return True
+
+    def _request_sync(self, message: str):
+        """
+        Local files, selection or settings changed so "links" may need to change.
+        Sync that is already past reading local files may miss the change, so another one is run after it.
+        """
+        with self._sync_state_mutex:
+            if self._sync_state in (SYNC_ACTIVE, SYNC_COMPLETE):
+                self._logger.info("Sync is '%s', syncing again after it : %s", self._sync_state, message)
+                self._metrics.increment("sync.retriggers")
+                self._sync_retrigger = True
+            elif self._is_ready_for_sync():
+                self._move_to_state(SYNC_NEEDED, start_sync=True, message=message, expected=(SYNC_IDLE, SYNC_NEEDED))
+            else:
+                self._move_to_state(SYNC_NEEDED, message=message, expected=(SYNC_IDLE,))
+
+    def _retrigger_sync(self) -> bool:
+        """
+        Start sync requested while previous one was running, returns True if there was one
+        """
+        with self._sync_state_mutex:
+            if not self._sync_retrigger:
+                return False
+            self._sync_retrigger = False
+            self._request_sync("changes during previous sync")
+            return True
+
+    def _start_sync(self, quiet_time: Optional[float] = None):
+        with self._sync_state_mutex:
+            if self._sync_state != SYNC_NEEDED:
+                self._logger.info("Sync state is '%s' - not starting", self._sync_state)
+                return
+            merged = self._sync_scheduler.trigger(quiet_time)
+        if merged:
+            self._logger.info("Sync already scheduled, merged %d triggers", merged)
+            self._metrics.increment("sync.merged_triggers")
+
+    def _launch_sync(self, merged_triggers: int):
+        """
+        Called in worker by sync scheduler when triggers have calmed down
+        """
+        if not self._printer.is_operational() or self._printer.is_printing():
+            self._logger.info("Printer is not available, sync stays pending")
+            return
+        self._sync_paused = False
+        with self._sync_state_mutex:
+            if not self._move_to_state(SYNC_LAUNCHING, message=f"Launching after {merged_triggers + 1} triggers",
+                                       expected=(SYNC_NEEDED,)):
+                self._logger.info("Sync state is '%s' - not launching", self._sync_state)
+                return
+            self._sync_token.cancel()
+            token = self._sync_token = CancelToken()
+            self._sync_launched = time.perf_counter()
+            self._sd_wait_delays = backoff_delays(0.5, 8, self._sd_wait_max_time, jitter=0)
+
+        # SD content may not be available right now, printer tells when it is and polling is a fallback
+        self._wait_for_sd(token, "poll")
+
+    def _on_sd_ready(self, source: str, delay: float = 0):
+        """
+        Printer or OctoPrint signalled that SD card is ready
+        """
+        token = self._sync_token
+        if not token.cancelled:
+            self._worker.schedule(delay, lambda: self._wait_for_sd(token, source, poll=False), token)
+
+    def _wait_for_sd(self, token: CancelToken, source: str, poll: bool = True):
+        if token.cancelled or self._sync_state != SYNC_LAUNCHING:
+            return
+        if self._printer.is_sd_ready():
+            token.cancel()  # no more polling
+            self._metrics.observe("sync.waiting_for_sd", time.perf_counter() - self._sync_launched)
+            self._metrics.increment(f"sync.sd_ready.{source}")
+            self.sync_sd_with_local()
             return
-        if self.timer is not None:
-            self.timer.cancel()  # connected, don't try again :)
-            self.timer = None
-
-        def condition():
-            return self._max_sync_attempts > 0 and self._waiting_for_sync
-
-        def do_sync():
-            self._max_sync_attempts -= 1
-            if self._printer.is_sd_ready():
-                self._waiting_for_sync = False
-                self.sync_sd_with_local()
-
-        # launch link file sync in separate thread, SD content is not available right now
-        self.timer = RepeatedTimer(2, do_sync, run_first=True, condition=condition)
-        self._waiting_for_sync = True
-        self._max_sync_attempts = 20
-        self._move_to_state(SYNC_LAUNCHING, message="Launching")
-        self.timer.start()
-        t = threading.Timer(2, do_sync)
-        t.start()
-
-    def get_latest_local_files(self, number_of_files: Optional[int]) -> List[Tuple]:
+        if not poll:
+            return
+
+        delay = next(self._sd_wait_delays, None)
+        if delay is not None:
+            self._worker.schedule(delay, lambda: self._wait_for_sd(token, "poll"), token)
+        else:
+            self._logger.info("SD card did not get ready, sync stays pending")
+            self._move_to_state(SYNC_NEEDED, message="SD not ready", expected=(SYNC_LAUNCHING,))
+
+    def _select_on_connect(self):
+        self._refresh_file_cache()
+        with self._metrics.span("select"):
+            # at this time only top 1 interests us ;)
+            file = next(self.get_ranked_local_files(1), None)
+            if file is not None:
+                path = file.path
+
+                # select that file
+                self._logger.info("Selecting %s on %s by policy %s", path, LOCAL,
+                                  self._selection_policy.name)
+                self._select_file(path)
+            else:
+                self._logger.info("No local files to select from")
+
+    def _select_file(self, path: str):
+        self._own_selections.add(path)
+        try:
+            self._printer.select_file(path, False, False)
+        except Exception:
+            self._own_selections.discard(path)
+            raise
+
+    def get_latest_local_files(self, number_of_files: Optional[int]) -> Iterator[FileRecord]:
+        return self.get_ranked_local_files(number_of_files, SelectionPolicy())
+
+    def get_ranked_local_files(self, number_of_files: Optional[int],
+                               policy: Optional[SelectionPolicy] = None) -> Iterator[FileRecord]:
+        """
+        Best local files by selection policy, configured policy by default.
+        Records are the ones in index, not copies, don't change them.
+        Index is not rebuilt here, call _refresh_file_cache() first in worker if it has to be up to date.
+        """
+        policy = policy or self._selection_policy
+        history = self._get_selection_history()
+        shared_index = self._get_shared_index()
+        if shared_index is not None:
+            with self._metrics.span("local_files"):
+                ranked_host_files = policy.rank((FileRecord(*x) for x in shared_index.iter_newest()),
+                                                self._shared_index_record, history, number_of_files)
+        else:
+            with self._metrics.span("local_files"), self._file_cache_mutex:
+                file_cache = self._file_cache
+                # index is kept in date order, so only as many files are looked at as policy needs
+                newest_first = (file_cache[x] for x in self._file_order.newest_first())
+                ranked_host_files = policy.rank(newest_first, file_cache.get, history, number_of_files)
+        return iter(ranked_host_files)
+
+    ##~~ Local file index
+
+    def _refresh_file_cache(self):
+        """
+        Rebuild local file index from full listing if it is cold or has drifted.
+        Only in worker, serial comm and event threads use the index they find.
+        """
+        with self._file_cache_mutex:
+            self._file_cache_rebuild_pending = False
+        self._elect_shared_index_writer()
+        shared_index = self._get_shared_index()
+        if shared_index is not None and not shared_index.is_writer:
+            return  # instance writing the shared index keeps it up to date
+        if not self._file_cache_valid:
+            self._rebuild_file_cache()
+
+    def _warm_file_cache(self):
+        with self._metrics.span("startup.warm_index"):
+            self._refresh_file_cache()
+
+    def _rebuild_file_cache(self):
         # get all local gcode files
-        host_files = self._file_manager.list_files(FileDestinations.LOCAL, filter=filter_machinecode, recursive=True)
-        host_files = host_files["local"] if "local" in host_files else dict()
-
-        # extract dates and paths, other attributes not needed
-        if host_files:
-            newest_host_files: List[Tuple] = []
-            for key in host_files:
-                file = host_files[key]
-                if "gcode" in file["typePath"]:  # filter out directories
-                    date = file["date"]
-                    path = file["path"]
-                    # display name is most useful, just make short version for comparison
-                    display_raw = file["display"]
-                    display_raw = display_raw[1:] if display_raw.startswith("/") else display_raw
-                    display = "/" + self._short_filename(display_raw)  # match with /XXX theme
-                    name = file["name"]
-                    newest_host_files.append((date, path, display, name))
-
-            # sort files to latest (youngest) first
-            newest_host_files.sort(reverse=True, key=lambda f: f[0])
-            if number_of_files is not None:
-                newest_host_files = newest_host_files[:number_of_files]  # x newest
+        self._metrics.increment("file_index.rescans")
+        with self._metrics.span("file_index.rescan"):
+            self._do_rebuild_file_cache()
+
+    def _do_rebuild_file_cache(self):
+        with self._file_cache_mutex:
+            version = self._file_cache_version
+        # listing and building new index don't block lookups, which use the previous index meanwhile
+        files = self._file_manager.list_files(LOCAL, filter=filter_machinecode, recursive=True)
+        files = files["local"] if "local" in files else dict()
+
+        file_cache = dict()
+        self._collect_files(files, file_cache)
+        file_lookup = dict()
+        for record in file_cache.values():
+            for key in self._lookup_keys(record):
+                self._add_lookup(file_lookup, key, record.path)
+        file_order = DateOrder()
+        file_order.rebuild(file_cache.values())
+        with self._shared_index_mutex:
+            with self._file_cache_mutex:
+                self._file_cache = file_cache
+                self._file_lookup = file_lookup
+                self._file_order = file_order
+                # listing may have missed changes made meanwhile, they have queued another rebuild
+                self._file_cache_valid = version == self._file_cache_version
+            # lookups read shared index meanwhile, only deltas wait for this
+            if self._is_shared_index_writer():
+                self._shared_index.replace_all(self._shared_index_row(x) for x in file_cache.values())
+        self._logger.info("Indexed %d local files", len(file_cache))
+        if self._get_selection_history().changed:
+            self._save_selection_history()
+
+    def _collect_files(self, nodes: dict, file_cache: Dict[str, FileRecord]):
+        for node in nodes.values():
+            if "children" in node:
+                self._collect_files(node["children"], file_cache)
+            elif "gcode" in node["typePath"]:  # filter out directories
+                # extract dates and paths, other attributes not needed
+                file_cache[node["path"]] = FileRecord(node["date"], node["path"], node["display"], node["name"])
+                self._note_print_history(node)
+
+    def _invalidate_file_cache(self, reason: str):
+        """
+        Rescan local files in worker, previous index is used until that is done
+        """
+        with self._file_cache_mutex:
+            if self._file_cache_valid:
+                self._logger.info("Local file index drifted (%s), rescanning", reason)
+                self._metrics.increment("file_index.drift")
+            self._file_cache_valid = False
+            self._file_cache_version += 1
+            if self._file_cache_rebuild_pending:
+                return
+            self._file_cache_rebuild_pending = True
+        self._worker.submit(self._refresh_file_cache)
+
+    def _add_to_file_cache(self, path: str) -> bool:
+        """
+        Read single file entry by listing only its own folder, index is locked only for updating it
+        """
+        folder = path.rsplit("/", 1)[0] if "/" in path else None
+        files = self._file_manager.list_files(LOCAL, path=folder, filter=filter_machinecode,
+                                              recursive=False)
+        files = files["local"] if "local" in files else dict()
+        node = next((x for x in files.values() if x.get("path") == path), None)
+        if node is None or "gcode" not in node["typePath"]:
+            return False
+        record = FileRecord(node["date"], node["path"], node["display"], node["name"])
+        self._note_print_history(node)
+        with self._shared_index_mutex:
+            if not self._is_shared_index_reader():
+                with self._file_cache_mutex:
+                    self._unindex_file(path)
+                    self._index_file(record)
+            if self._shared_index is not None:
+                self._shared_index.upsert(self._shared_index_row(record))
+        return True
+
+    def _remove_from_file_cache(self, path: str) -> bool:
+        with self._shared_index_mutex:
+            if self._is_shared_index_reader():
+                return self._shared_index.delete(path)
+            with self._file_cache_mutex:
+                removed = self._unindex_file(path)
+            if removed and self._shared_index is not None:
+                self._shared_index.delete(path)
+            return removed
+
+    def _unindex_file(self, path: str) -> bool:
+        record = self._file_cache.pop(path, None)
+        if record is None:
+            return False
+        self._file_order.remove(record.date, path)
+        for key in self._lookup_keys(record):
+            paths = self._file_lookup.get(key)
+            if paths == path:
+                del self._file_lookup[key]
+            elif isinstance(paths, set):
+                paths.discard(path)
+                if len(paths) == 1:
+                    self._file_lookup[key] = paths.pop()
+        return True
+
+    def _index_file(self, record: FileRecord):
+        path = record.path
+        self._file_cache[path] = record
+        self._file_order.add(record.date, path)
+        for key in self._lookup_keys(record):
+            self._add_lookup(self._file_lookup, key, path)
+
+    @staticmethod
+    def _add_lookup(file_lookup: Dict[str, Union[str, set]], key: str, path: str):
+        # most names belong to one file, set only for the few that don't
+        paths = file_lookup.get(key)
+        if paths is None:
+            file_lookup[key] = path
+        elif isinstance(paths, set):
+            paths.add(path)
+        elif paths != path:
+            file_lookup[key] = {paths, path}
+
+    def _lookup_keys(self, record: FileRecord) -> Tuple:
+        """
+        Names other than path that //action:start_file may refer the file with: SD "link" name and display name
+        """
+        display_raw = record.display
+        display_raw = display_raw[1:] if display_raw.startswith("/") else display_raw
+        return self._short_filename(display_raw), display_raw
+
+    def _lookup_local_file(self, file_name: str) -> Optional[str]:
+        """
+        Resolve action command file name to local path, newest file wins if name is ambiguous.
+        Called in serial comm thread, so index is never rebuilt here.
+        """
+        file_name = file_name[1:] if file_name.startswith("/") else file_name
+        shared_index = self._get_shared_index()
+        if shared_index is not None:
+            path = self._get_short_names().path_of(file_name)
+            if path is not None and shared_index.lookup(path) == path:
+                return path
+            found = shared_index.lookup(file_name)
+            # file may have been added by instance that has not told the shared index yet
+            return found if found is not None else self._find_on_disk(path, file_name)
+
+        with self._file_cache_mutex:
+            file_cache = self._file_cache
+            # names of SD "links" are unique
+            path = self._get_short_names().path_of(file_name)
+            if path in file_cache:
+                return path
+            paths = self._file_lookup.get(file_name, ())
+            paths = (paths,) if isinstance(paths, str) else tuple(paths)
+            if file_name in file_cache:
+                paths += (file_name,)
+            if paths:
+                # tie-break by date and then path to be deterministic
+                return max(paths, key=lambda x: (file_cache[x].date, x))
+            valid = self._file_cache_valid
+        # index is being rebuilt and may not have the file yet
+        return self._find_on_disk(path, file_name) if not valid else None
+
+    def _find_on_disk(self, *candidates: Optional[str]) -> Optional[str]:
+        """
+        First candidate path that is a local file, for files index does not have
+        """
+        for candidate in candidates:
+            if candidate is not None and self._file_manager.file_exists(LOCAL, candidate):
+                return candidate
+        return None
+
+    @staticmethod
+    def _is_local_gcode_event(payload: Optional[dict]) -> bool:
+        if payload is None:
+            return False
+        if "source_path" in payload:  # FILE_MOVED
+            return any(payload.get(f"{x}_storage") == LOCAL and is_machinecode(payload.get(f"{x}_path"))
+                       for x in ("source", "destination"))
+        return payload.get("storage", payload.get("target")) == LOCAL and is_machinecode(payload.get("path"))
+
+    def _apply_file_event(self, event: str, payload: Optional[dict]):
+        """
+        Apply file event payload to local file index as delta.
+        OctoPrint tells only the instance that changed the file, so shared index readers write their own deltas.
+        """
+        if payload is None:
+            return
+        self._get_shared_index()
+        with self._file_cache_mutex:
+            if not self._file_cache_valid and not self._is_shared_index_reader():
+                # rescan may have listed files before this change
+                self._invalidate_file_cache(f"{event} during rescan")
+                return
+
+        # each step locks the index only for updating it, folder listing is done without the lock
+        try:
+            if event == octoprint.events.Events.FILE_MOVED:
+                if payload.get("source_storage") == LOCAL and is_machinecode(payload["source_path"]):
+                    self._remove_from_file_cache(payload["source_path"])
+                if payload.get("destination_storage") == LOCAL and is_machinecode(payload["destination_path"]):
+                    if not self._add_to_file_cache(payload["destination_path"]):
+                        self._invalidate_file_cache(f"moved file {payload['destination_path']} not found")
+                return
+
+            storage = payload.get("storage", payload.get("target"))
+            path = payload["path"]
+            if storage != LOCAL or not is_machinecode(path):
+                return
+            if event == octoprint.events.Events.FILE_REMOVED:
+                if not self._remove_from_file_cache(path):
+                    self._invalidate_file_cache(f"removed file {path} was not indexed")
+            elif not self._add_to_file_cache(path):
+                self._invalidate_file_cache(f"added file {path} not found")
+        except Exception:
+            self._logger.exception("Could not apply %s to local file index", event)
+            self._invalidate_file_cache(f"{event} failed")
+
+    ##~~ Selection history
+
+    def _get_selection_history(self) -> SelectionHistory:
+        if self._selection_history is None:
+            history = SelectionHistory(os.path.join(self.get_plugin_data_folder(), "selection_history.json"))
+            history.load()
+            self._selection_history = history
+        return self._selection_history
+
+    def _update_selection_history(self, payload: Optional[dict], printed: bool) -> bool:
+        """
+        Record printed or selected local file, returns True if selection policy may rank files differently now
+        """
+        if payload is None or payload.get("origin") != LOCAL or not payload.get("path"):
+            return False
+        history = self._get_selection_history()
+        if printed:
+            history.mark_printed(payload["path"])
         else:
-            newest_host_files = list()
+            history.mark_selected(payload["path"])
+        changed = history.changed
+        if changed:
+            self._save_selection_history()
+        return changed and self._selection_policy.name in (POLICY_NEWEST_NOT_PRINTED, POLICY_RECENTLY_SELECTED)
+
+    def _forget_selection_history(self, path: Optional[str]):
+        if path is None:
+            return
+        history = self._get_selection_history()
+        history.forget(path)
+        if history.changed:
+            self._save_selection_history()
+
+    def _note_print_history(self, node: dict):
+        """
+        Take successful prints from OctoPrint file metadata into selection history
+        """
+        prints = node.get("prints")
+        if prints and prints.get("success"):
+            self._get_selection_history().mark_printed(node["path"])
 
-        return newest_host_files
+    def _save_selection_history(self):
+        try:
+            self._get_selection_history().save()
+        except Exception:
+            self._logger.exception("Could not save selection history")
+
+    ##~~ Shared file index
+
+    def _get_shared_index(self) -> Optional["SharedFileIndex"]:
+        """
+        Shared file index if configured, opened on first use
+        """
+        if not self._shared_index_path:
+            return None
+        shared_index = self._shared_index
+        if shared_index is not None:
+            return shared_index
+        try:
+            with self._shared_index_mutex:
+                if self._shared_index is None:
+                    from .shared_index import SharedFileIndex
+                    shared_index = SharedFileIndex(self._shared_index_path)
+                    shared_index.open()
+                    self._shared_index = shared_index
+                return self._shared_index
+        except Exception:
+            self._logger.exception("Could not use shared file index %s, using local index", self._shared_index_path)
+            with self._shared_index_mutex:
+                self._shared_index_path = None
+                self._close_shared_index()
+            return None
+
+    def _elect_shared_index_writer(self):
+        """
+        Try to become the instance that rebuilds shared index, in worker only as it takes a file lock
+        """
+        shared_index = self._get_shared_index()
+        if shared_index is not None and shared_index.try_become_writer():
+            self._logger.info("Writing shared file index %s", self._shared_index_path)
+            self._metrics.increment("shared_index.writer_elected")
+            self._invalidate_file_cache("became writer of shared index")
+
+    def _is_shared_index_writer(self) -> bool:
+        return self._shared_index is not None and self._shared_index.is_writer
+
+    def _is_shared_index_reader(self) -> bool:
+        return self._shared_index is not None and not self._shared_index.is_writer
+
+    def _shared_index_row(self, record: FileRecord) -> Tuple:
+        display_raw = record.display
+        display_raw = display_raw[1:] if display_raw.startswith("/") else display_raw
+        return record.date, record.path, display_raw, record.name, self._short_filename(display_raw)
+
+    def _shared_index_record(self, path: str) -> Optional[FileRecord]:
+        row = self._shared_index.entry(path)
+        return FileRecord(*row) if row is not None else None
+
+    def _close_shared_index(self):
+        if self._shared_index is not None:
+            self._shared_index.close()
+            self._shared_index = None
+
+    ##~~ SettingsPlugin mixin
+
+    def get_settings_defaults(self):
+        return {
+            # newest, newest_in_folder, newest_not_printed or recently_selected
+            "selection_policy": POLICY_NEWEST,
+            "selection_folder": "",
+            "max_host_files": 5,
+            "host_sd_directory": DEFAULT_HOST_SD_DIRECTORY,
+            "connect_max_time": 40,
+            "sync_quiet_time": 5,
+            "sync_max_delay": 30,
+            "sd_name_max_length": None,
+            "sd_dos_names": False,
+            "shared_index_path": "",
+        }
+
+    def on_settings_initialized(self):
+        self._apply_settings()
+
+    def on_settings_save(self, data):
+        diff = octoprint.plugin.SettingsPlugin.on_settings_save(self, data)
+        if self._apply_settings():
+            self._request_sync("after settings change")
+        return diff
+
+    def _apply_settings(self) -> bool:
+        """
+        Take settings into use, returns True if "links" need to be synced again
+        """
+        links_before = (self._selection_policy.name, self._selection_policy.folder,
+                        self._max_host_files, self._host_sd_directory)
+        names_before = (self._sd_name_max_length, self._sd_dos_names)
+
+        policy_name = self._settings.get(["selection_policy"])
+        try:
+            self._selection_policy = create_policy(policy_name, self._settings.get(["selection_folder"]) or "")
+        except ValueError:
+            self._logger.warning("Unknown selection policy '%s', using %s", policy_name, POLICY_NEWEST)
+            self._selection_policy = SelectionPolicy()
+        self._max_host_files = max(self._settings.get_int(["max_host_files"]) or 0, 0)
+        host_sd_directory = (self._settings.get(["host_sd_directory"]) or "").strip().strip("/")
+        if not host_sd_directory:
+            # sync owns every file in the directory, SD card root would lose all printer's own files
+            self._logger.warning("SD directory for host files can't be empty, using %s",
+                                 DEFAULT_HOST_SD_DIRECTORY)
+            host_sd_directory = DEFAULT_HOST_SD_DIRECTORY.strip("/")
+        self._host_sd_directory = f"{host_sd_directory}/"
+        self._connect_max_time = self._settings.get_float(["connect_max_time"]) or 0
+        self._sync_quiet_time = self._sync_scheduler.quiet_time = self._settings.get_float(["sync_quiet_time"]) or 0
+        self._sync_max_delay = self._sync_scheduler.max_delay = self._settings.get_float(["sync_max_delay"]) or 0
+        self._sd_name_max_length = self._settings.get_int(["sd_name_max_length"]) or None
+        if self._sd_name_max_length is not None and self._sd_name_max_length < MIN_NAME_LENGTH:
+            self._logger.warning("SD file names can't be shorter than %d characters, using %d",
+                                 MIN_NAME_LENGTH, MIN_NAME_LENGTH)
+            self._sd_name_max_length = MIN_NAME_LENGTH
+        self._sd_dos_names = bool(self._settings.get_boolean(["sd_dos_names"]))
+
+        if (self._sd_name_max_length, self._sd_dos_names) != names_before:
+            # "link" names and names used in action command lookups change
+            self._short_names = None
+            self._invalidate_file_cache("SD name format changed")
+        shared_index_path = self._settings.get(["shared_index_path"]) or None
+        if shared_index_path != self._shared_index_path:
+            with self._shared_index_mutex:
+                self._close_shared_index()
+                self._shared_index_path = shared_index_path
+                self._invalidate_file_cache("shared index changed")
+
+        links_after = (self._selection_policy.name, self._selection_policy.folder,
+                       self._max_host_files, self._host_sd_directory)
+        return links_after != links_before or (self._sd_name_max_length, self._sd_dos_names) != names_before
+
+    ##~~ ShutdownPlugin mixin
+
+    def on_shutdown(self):
+        self._sync_scheduler.cancel()
+        self._worker.stop()
+        with self._shared_index_mutex:
+            self._close_shared_index()
+
+    ##~~ SimpleApiPlugin mixin
+
+    def on_api_get(self, request):
+        """
+        Timings, counters and state of the plugin as JSON
+        """
+        data = self._metrics.to_dict()
+        data["sync_state"] = self._sync_state
+        data["sync_scheduler"] = {
+            "merged": self._sync_scheduler.total_merged,
+            "fired": self._sync_scheduler.total_fired,
+        }
+        with self._file_cache_mutex:
+            data["file_index"] = {"files": len(self._file_cache), "valid": self._file_cache_valid}
+            if self._shared_index is not None:
+                data["file_index"]["shared"] = {
+                    "path": self._shared_index_path,
+                    "writer": self._shared_index.is_writer,
+                    "files": self._shared_index.count(),
+                }
+        return flask.jsonify(data)
 
     ##~~ Softwareupdate hook
 
@@ -417,3 +1415,6 @@ class AutoConnectAndSelectFilePlugin(octoprint.plugin.EventHandlerPlugin):
                 "pip": "https://github.com/KimmoHop/Octoprint-AutoselectOnConnect/archive/{target_version}.zip",
             }
         }
+
+
+_import_time = time.perf_counter() - _import_started
@@ -0,0 +1,62 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import random
+from typing import Dict, Iterator, Optional, Tuple
+
+from .data_file import load_json, save_json
+
+# printer states while OctoPrint is still working on a connection, see octoprint.util.comm.MachineCom
+CONNECTING_STATES = ("OPEN_SERIAL", "DETECT_SERIAL", "DETECT_BAUDRATE", "CONNECTING")
+
+
+# shortest delay between attempts, so zero settings can't make attempts run back to back forever
+MIN_DELAY = 0.5
+
+
+def backoff_delays(initial: float, maximum: float, total: float, factor: float = 2.0,
+                   jitter: float = 0.25) -> Iterator[float]:
+    """
+    Exponentially growing delays between connection attempts, randomized by +-jitter,
+    until total time would be exceeded. Delays are at least MIN_DELAY, except the last one.
+    """
+    maximum = max(maximum, MIN_DELAY)
+    elapsed = 0.0
+    delay = min(max(initial, MIN_DELAY), maximum)
+    while elapsed < total:
+        jittered = min(max(delay * random.uniform(1 - jitter, 1 + jitter), MIN_DELAY), total - elapsed)
+        elapsed += jittered
+        yield jittered
+        delay = min(delay * factor, maximum)
+
+
+class ConnectionMemory:
+    """
+    Last successful port and baudrate for each configured port (which may be AUTO)
+    """
+
+    def __init__(self, file_path: str):
+        self._file_path = file_path
+        self._connections: Dict[str, dict] = {}
+
+    def load(self):
+        self._connections = load_json(self._file_path)
+
+    def save(self):
+        save_json(self._file_path, self._connections)
+
+    def get(self, configured_port: Optional[str]) -> Optional[Tuple[str, int]]:
+        connection = self._connections.get(str(configured_port))
+        if connection is None:
+            return None
+        return connection["port"], connection["baudrate"]
+
+    def remember(self, configured_port: Optional[str], port: str, baudrate: int) -> bool:
+        """
+        Returns True if something changed
+        """
+        connection = {"port": port, "baudrate": baudrate}
+        if self._connections.get(str(configured_port)) == connection:
+            return False
+        self._connections[str(configured_port)] = connection
+        return True
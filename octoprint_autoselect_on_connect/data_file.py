@@ -0,0 +1,24 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import json
+
+from octoprint.util import atomic_write
+
+
+def load_json(file_path: str) -> dict:
+    """
+    Read JSON object from plugin data folder.
+    Missing or unreadable file reads as empty, so state starts over instead of failing.
+    """
+    try:
+        with open(file_path, "rt", encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return dict()
+    return data if isinstance(data, dict) else dict()
+
+
+def save_json(file_path: str, data: dict):
+    with atomic_write(file_path, mode="wt") as f:
+        json.dump(data, f, indent=2)
@@ -0,0 +1,70 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import bisect
+from array import array
+from typing import Iterable, Iterator, List, Optional
+
+
+class FileRecord:
+    """
+    Local gcode file in index. Name is the last part of path,
+    display name is stored only if it differs from name, which it rarely does.
+    """
+    __slots__ = ("date", "path", "_display")
+
+    def __init__(self, date: float, path: str, display: str, name: Optional[str] = None):
+        self.date = date
+        self.path = path
+        self._display = None if display == (name or self.name) else display
+
+    @property
+    def name(self) -> str:
+        return self.path.rsplit("/", 1)[-1]
+
+    @property
+    def display(self) -> str:
+        return self.name if self._display is None else self._display
+
+    def __repr__(self):
+        return f"FileRecord({self.date!r}, {self.path!r}, {self.display!r})"
+
+
+class DateOrder:
+    """
+    Paths sorted by (date, path), dates are kept in an array instead of a tuple for each file
+    """
+
+    def __init__(self):
+        self._dates = array("d")
+        self._paths: List[str] = []
+
+    def __len__(self) -> int:
+        return len(self._paths)
+
+    def rebuild(self, records: Iterable[FileRecord]):
+        ordered = sorted(records, key=lambda x: (x.date, x.path))
+        self._dates = array("d", (x.date for x in ordered))
+        self._paths = [x.path for x in ordered]
+
+    def add(self, date: float, path: str):
+        position = self._position(date, path)
+        self._dates.insert(position, date)
+        self._paths.insert(position, path)
+
+    def remove(self, date: float, path: str) -> bool:
+        position = self._position(date, path)
+        if position < len(self._paths) and self._paths[position] == path and self._dates[position] == date:
+            del self._dates[position]
+            del self._paths[position]
+            return True
+        return False
+
+    def newest_first(self) -> Iterator[str]:
+        return reversed(self._paths)
+
+    def _position(self, date: float, path: str) -> int:
+        low = bisect.bisect_left(self._dates, date)
+        high = bisect.bisect_right(self._dates, date, low)
+        # paths of same date are in order
+        return bisect.bisect_left(self._paths, path, low, high)
@@ -0,0 +1,137 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import hashlib
+import mmap
+import os
+import re
+from typing import List, Optional
+
+# bump when rendered content changes, old cache entries are not used then
+LINK_FORMAT_VERSION = 2
+
+# slicers write settings to the beginning and print statistics to the end of file
+HEADER_BYTES = 512 * 1024
+TRAILER_BYTES = 64 * 1024
+
+_PRINT_TIME_TEXT = re.compile(r"^;\s*estimated printing time(?: \(normal mode\))?\s*[=:]\s*(.+)$", re.IGNORECASE)
+_PRINT_TIME_SECONDS = re.compile(r"^;\s*(?:TIME|PRINT\.TIME):\s*(\d+)", re.IGNORECASE)
+_FILAMENT_MM = re.compile(r"^;\s*filament used \[mm\]\s*=\s*([\d.]+)", re.IGNORECASE)
+_FILAMENT_M = re.compile(r"^;\s*filament used:\s*([\d.]+)\s*m\b", re.IGNORECASE)
+
+
+def read_gcode_metadata(file_path: str) -> dict:
+    """
+    Read print time and filament from gcode file without reading the whole file,
+    only the beginning and the end are mapped
+    """
+    metadata = {"print_time": None, "filament": None}
+    with open(file_path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return metadata
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            header = mapped[:HEADER_BYTES]
+            trailer = mapped[max(HEADER_BYTES, size - TRAILER_BYTES):] if size > HEADER_BYTES else b""
+
+    for chunk in (header, trailer):
+        for raw in chunk.splitlines():
+            if not raw.startswith(b";"):
+                continue
+            line = raw.decode("utf-8", errors="replace").rstrip()
+
+            match = _PRINT_TIME_TEXT.match(line)
+            if match:
+                metadata["print_time"] = match.group(1).replace(" ", "")
+                continue
+            match = _PRINT_TIME_SECONDS.match(line)
+            if match:
+                metadata["print_time"] = _format_seconds(int(match.group(1)))
+                continue
+            match = _FILAMENT_MM.match(line)
+            if match:
+                metadata["filament"] = f"{float(match.group(1)) / 1000:.2f}m"
+                continue
+            match = _FILAMENT_M.match(line)
+            if match:
+                metadata["filament"] = f"{float(match.group(1)):.2f}m"
+    return metadata
+
+
+def _format_seconds(seconds: int) -> str:
+    hours, seconds = divmod(seconds, 3600)
+    minutes = seconds // 60
+    return f"{hours}h{minutes:02d}m" if hours else f"{minutes}m"
+
+
+def render_link(action_command: str, path: str, metadata: Optional[dict]) -> List[str]:
+    """
+    Commands to write into "link" file between M28 and M29.
+    Only commands, OctoPrint strips comments so they would never get to the SD card.
+    """
+    metadata = metadata or dict()
+    lines = []
+    details = " ".join(x for x in (metadata.get("print_time"), metadata.get("filament")) if x)
+    # printer shows the message when print starts, so print time and filament are visible there
+    lines.append(f"M117 Host print {details}" if details else "M117 Starting host print...")
+    lines.append(f"M118 A1 action: {action_command} {path}")
+    return lines
+
+
+def link_checksum(lines: List[str]) -> str:
+    return hashlib.sha1("\n".join(lines).encode("utf-8")).hexdigest()
+
+
+def link_sizes(lines: List[str]) -> List[int]:
+    """
+    Sizes "link" file may have on SD card: firmware ends lines with LF or CR LF
+    """
+    length = sum(len(x.encode("utf-8")) for x in lines)
+    return [length + ending * len(lines) for ending in (1, 2)]
+
+
+class LinkFileCache:
+    """
+    Rendered "link" file contents in files named by hash of local path, modification time and size,
+    so a changed gcode file gets new content and unchanged content is never rendered twice
+    """
+
+    def __init__(self, folder: str, max_entries: int = 200):
+        self._folder = folder
+        self._max_entries = max_entries
+        os.makedirs(folder, exist_ok=True)
+
+    @staticmethod
+    def key(path: str, mtime: float, size: int, variant: str = "") -> str:
+        return hashlib.sha1(f"{LINK_FORMAT_VERSION}\0{path}\0{mtime}\0{size}\0{variant}".encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[List[str]]:
+        file_path = os.path.join(self._folder, key + ".gcode")
+        try:
+            with open(file_path, "rt", encoding="utf-8") as f:
+                lines = f.read().splitlines()
+            os.utime(file_path)  # recently used entries are kept when pruning
+            return lines
+        except OSError:
+            return None
+
+    def put(self, key: str, lines: List[str]):
+        file_path = os.path.join(self._folder, key + ".gcode")
+        temp_path = file_path + ".tmp"
+        with open(temp_path, "wt", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(temp_path, file_path)
+
+    def prune(self):
+        """
+        Remove least recently used entries above max_entries
+        """
+        entries = [x for x in os.scandir(self._folder) if x.name.endswith(".gcode")]
+        if len(entries) <= self._max_entries:
+            return
+        entries.sort(key=lambda x: x.stat().st_mtime, reverse=True)
+        for entry in entries[self._max_entries:]:
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass
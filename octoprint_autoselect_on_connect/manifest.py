@@ -0,0 +1,110 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import time
+from typing import Dict, List, Optional, Tuple
+
+from .data_file import load_json, save_json
+
+
+class LinkManifest:
+    """
+    Persisted record of "link" files this plugin has written to printer SD host directory.
+    Entries are keyed by short name and hold local path, local file date and printer's own (8.3) name if known,
+    and checksum and possible sizes of written content for verifying it.
+    Entries left in previous host directory are retired by their printer names until they are deleted.
+    """
+
+    def __init__(self, file_path: str):
+        self._file_path = file_path
+        self.directory: Optional[str] = None
+        self.entries: Dict[str, dict] = {}
+        self.retired: List[str] = []
+        self.verified_at: Optional[float] = None
+        self.stale = True
+
+    def load(self):
+        # unreadable manifest is same as no manifest, SD card listing tells the truth
+        data = load_json(self._file_path)
+        self.directory = data.get("directory")
+        self.entries = data.get("entries", dict())
+        self.retired = data.get("retired", list())
+        self.verified_at = data.get("verified_at")
+        self.stale = data.get("stale", True)
+
+    def save(self):
+        data = {
+            "directory": self.directory,
+            "entries": self.entries,
+            "retired": self.retired,
+            "verified_at": self.verified_at,
+            "stale": self.stale,
+        }
+        save_json(self._file_path, data)
+
+    def is_stale(self, max_age: float) -> bool:
+        return self.stale or self.verified_at is None or time.time() - self.verified_at > max_age
+
+    def change_directory(self, directory: str):
+        """
+        Follow host directory setting, entries of previous directory are retired to be deleted from SD
+        """
+        if self.directory is not None and self.directory != directory:
+            self.retired.extend(x.get("sd_name") or f"{self.directory}{short_name}"
+                                for short_name, x in self.entries.items())
+            self.entries = dict()
+            self.stale = True
+        self.directory = directory
+
+    def reconcile(self, sd_files: Dict[str, str], verified: bool = False):
+        """
+        Align entries with printer SD host directory listing (short name -> printer name).
+        Entries missing from SD are dropped so that they are written again,
+        unknown SD files are adopted without local path so that they get deleted.
+        """
+        for short_name in [x for x in self.entries if x not in sd_files]:
+            del self.entries[short_name]
+        for short_name, sd_name in sd_files.items():
+            entry = self.entries.setdefault(short_name, {"path": None, "date": None})
+            entry["sd_name"] = sd_name
+        if verified:
+            self.verified_at = time.time()
+            self.stale = False
+
+    def diff(self, wanted: Dict[str, Tuple[str, int]]) -> Tuple[List[str], List[str]]:
+        """
+        Short names to delete from and to write to SD, given wanted short name -> (local path, date)
+        """
+        current = set(self.entries)
+        wanted_names = set(wanted)
+        changed = {x for x in current & wanted_names
+                   if self.entries[x]["path"] != wanted[x][0] or self.entries[x].get("repair")}
+        to_delete = sorted(current - wanted_names)
+        to_write = sorted((wanted_names - current) | changed, key=lambda x: wanted[x][1], reverse=True)
+        return to_delete, to_write
+
+    def add(self, short_name: str, path: str, date: int, checksum: Optional[str] = None,
+            sizes: Optional[List[int]] = None):
+        entry = {"path": path, "date": date, "checksum": checksum, "sizes": sizes}
+        previous = self.entries.get(short_name)
+        if previous is not None and previous["path"] == path and previous.get("repairs"):
+            # rewritten "link" is verified again before repairs are forgotten
+            entry["repairs"] = previous["repairs"]
+        self.entries[short_name] = entry
+
+    def mark_for_repair(self, short_name: str) -> int:
+        """
+        Have "link" written again by next diff, returns number of repairs of it since it was last verified
+        """
+        entry = self.entries[short_name]
+        entry["repair"] = True
+        entry["repairs"] = entry.get("repairs", 0) + 1
+        return entry["repairs"]
+
+    def mark_verified(self, short_name: str):
+        entry = self.entries[short_name]
+        entry.pop("repair", None)
+        entry.pop("repairs", None)
+
+    def remove(self, short_name: str):
+        self.entries.pop(short_name, None)
@@ -0,0 +1,86 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import bisect
+import contextlib
+import threading
+import time
+from typing import Dict, Iterator, List
+
+# upper bounds of histogram buckets in seconds, last bucket takes everything else
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60)
+
+
+class Histogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self._buckets = buckets
+        self.counts: List[int] = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.last = None
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self._buckets, value)] += 1
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        self.last = value
+
+    def to_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "sum": self.total,
+            "min": self.min,
+            "max": self.max,
+            "last": self.last,
+            "buckets": {
+                **{str(le): count for le, count in zip(self._buckets, self.counts)},
+                "+Inf": self.counts[-1],
+            },
+        }
+
+
+class Metrics:
+    """
+    Timing histograms and counters of plugin hot paths, thread safe
+    """
+
+    def __init__(self):
+        self._mutex = threading.Lock()
+        self._histograms: Dict[str, Histogram] = {}
+        self._counters: Dict[str, int] = {}
+        self._values: Dict[str, float] = {}
+
+    @contextlib.contextmanager
+    def span(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def observe(self, name: str, seconds: float):
+        with self._mutex:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = Histogram()
+            histogram.observe(seconds)
+
+    def increment(self, name: str, amount: int = 1):
+        with self._mutex:
+            self._counters[name] = self._counters.get(name, 0) + amount
+
+    def set(self, name: str, value: float):
+        with self._mutex:
+            self._values[name] = value
+
+    def to_dict(self) -> dict:
+        with self._mutex:
+            return {
+                "timings": {name: x.to_dict() for name, x in self._histograms.items()},
+                "counters": dict(self._counters),
+                "values": dict(self._values),
+            }
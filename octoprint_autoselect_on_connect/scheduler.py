@@ -0,0 +1,109 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import threading
+import time
+from typing import Any, Callable, Optional
+
+
+def _start_timer(interval: float, function: Callable[[], None]) -> threading.Timer:
+    timer = threading.Timer(interval, function)
+    timer.daemon = True
+    timer.start()
+    return timer
+
+
+class CoalescingTimer:
+    """
+    Run function once after triggers have been quiet for quiet_time seconds,
+    but no later than max_delay seconds after the first trigger of the batch.
+    Function is called with number of triggers that were merged into the first one.
+    schedule(delay, function) must return something with cancel(), by default a new threading.Timer is started.
+    """
+
+    def __init__(self, quiet_time: float, max_delay: float, function: Callable[[int], None],
+                 schedule: Optional[Callable[[float, Callable[[], None]], Any]] = None):
+        self.quiet_time = quiet_time
+        self.max_delay = max_delay
+        self._function = function
+        self._schedule = schedule or _start_timer
+
+        self._mutex = threading.Lock()
+        self._timer = None
+        self._timer_due: Optional[float] = None
+        self._run_before: Optional[float] = None
+        self._first_trigger: Optional[float] = None
+        self._last_trigger: Optional[float] = None
+        self._merged = 0
+        self.total_merged = 0
+        self.total_fired = 0
+
+    def trigger(self, quiet_time: Optional[float] = None) -> int:
+        """
+        Request a run, returns number of triggers merged so far into the pending run.
+        quiet_time shorter than the default brings the run forward.
+        """
+        with self._mutex:
+            now = time.monotonic()
+            if quiet_time is not None and quiet_time < self.quiet_time:
+                run_before = now + quiet_time
+                self._run_before = run_before if self._run_before is None else min(self._run_before, run_before)
+            if self._first_trigger is None:
+                self._first_trigger = now
+                self._merged = 0
+            else:
+                self._merged += 1
+                self.total_merged += 1
+            self._last_trigger = now
+
+            # timer is not recreated on every trigger, it checks the deadline when it expires
+            if self._timer is None:
+                self._start_timer(self._deadline() - now)
+            elif self._timer_due is not None and self._deadline() < self._timer_due:
+                self._timer.cancel()
+                self._start_timer(self._deadline() - now)
+            return self._merged
+
+    def cancel(self):
+        with self._mutex:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            self._timer_due = None
+            self._run_before = None
+            self._first_trigger = None
+            self._last_trigger = None
+            self._merged = 0
+
+    def is_pending(self) -> bool:
+        with self._mutex:
+            return self._first_trigger is not None
+
+    def _start_timer(self, interval: float):
+        interval = max(interval, 0)
+        self._timer_due = time.monotonic() + interval
+        self._timer = self._schedule(interval, self._fire)
+
+    def _deadline(self) -> float:
+        deadline = min(self._last_trigger + self.quiet_time, self._first_trigger + self.max_delay)
+        return deadline if self._run_before is None else min(deadline, self._run_before)
+
+    def _fire(self):
+        with self._mutex:
+            if self._first_trigger is None:
+                return  # cancelled
+            remaining = self._deadline() - time.monotonic()
+            if remaining > 0.01:
+                # more triggers arrived while waiting
+                self._start_timer(remaining)
+                return
+            merged = self._merged
+            self._timer = None
+            self._timer_due = None
+            self._run_before = None
+            self._first_trigger = None
+            self._last_trigger = None
+            self._merged = 0
+            self.total_fired += 1
+
+        self._function(merged)
@@ -0,0 +1,122 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import itertools
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Set
+
+from .data_file import load_json, save_json
+from .file_index import FileRecord
+
+POLICY_NEWEST = "newest"
+POLICY_NEWEST_IN_FOLDER = "newest_in_folder"
+POLICY_NEWEST_NOT_PRINTED = "newest_not_printed"
+POLICY_RECENTLY_SELECTED = "recently_selected"
+
+
+class SelectionHistory:
+    """
+    Local files that have been printed successfully, and when files were last selected
+    """
+
+    def __init__(self, file_path: str, max_selected: int = 100):
+        self._file_path = file_path
+        self._max_selected = max_selected
+        self.printed: Set[str] = set()
+        self.selected: Dict[str, float] = {}
+        self.changed = False
+
+    def load(self):
+        data = load_json(self._file_path)
+        self.printed = set(data.get("printed", []))
+        self.selected = dict(data.get("selected", {}))
+        self.changed = False
+
+    def save(self):
+        save_json(self._file_path, {"printed": sorted(self.printed), "selected": self.selected})
+        self.changed = False
+
+    def mark_printed(self, path: str):
+        if path not in self.printed:
+            self.printed.add(path)
+            self.changed = True
+
+    def mark_selected(self, path: str):
+        if self.selected and max(self.selected, key=self.selected.get) == path:
+            return  # already the most recent one, order does not change
+        self.selected[path] = time.time()
+        if len(self.selected) > self._max_selected:
+            for old_path in sorted(self.selected, key=self.selected.get)[:len(self.selected) - self._max_selected]:
+                del self.selected[old_path]
+        self.changed = True
+
+    def forget(self, path: str):
+        if path in self.printed or path in self.selected:
+            self.printed.discard(path)
+            self.selected.pop(path, None)
+            self.changed = True
+
+    def recently_selected(self) -> List[str]:
+        return sorted(self.selected, key=self.selected.get, reverse=True)
+
+
+class SelectionPolicy:
+    """
+    Ranks local files for selecting on connect and for SD "links", best first.
+    newest_first iterates index newest file first, and only as far as needed.
+    """
+    name = POLICY_NEWEST
+    folder = ""
+
+    def rank(self, newest_first: Iterable[FileRecord], lookup: Callable[[str], Optional[FileRecord]],
+             history: SelectionHistory, number_of_files: Optional[int]) -> List[FileRecord]:
+        return list(itertools.islice(self._candidates(newest_first, lookup, history), number_of_files))
+
+    def _candidates(self, newest_first: Iterable[FileRecord], lookup: Callable[[str], Optional[FileRecord]],
+                    history: SelectionHistory) -> Iterable[FileRecord]:
+        return newest_first
+
+
+class NewestInFolderPolicy(SelectionPolicy):
+    name = POLICY_NEWEST_IN_FOLDER
+
+    def __init__(self, folder: str):
+        self.folder = folder.strip("/")
+
+    def _candidates(self, newest_first, lookup, history):
+        prefix = f"{self.folder}/" if self.folder else ""
+        return (x for x in newest_first if x.path.startswith(prefix))
+
+
+class NewestNotPrintedPolicy(SelectionPolicy):
+    name = POLICY_NEWEST_NOT_PRINTED
+
+    def _candidates(self, newest_first, lookup, history):
+        return (x for x in newest_first if x.path not in history.printed)
+
+
+class RecentlySelectedPolicy(SelectionPolicy):
+    """
+    Most recently selected files first, then the newest ones
+    """
+    name = POLICY_RECENTLY_SELECTED
+
+    def _candidates(self, newest_first, lookup, history):
+        selected = [x for x in map(lookup, history.recently_selected()) if x is not None]
+        selected_paths = {x.path for x in selected}
+        return itertools.chain(selected, (x for x in newest_first if x.path not in selected_paths))
+
+
+def create_policy(name: str, folder: str = "") -> SelectionPolicy:
+    """
+    Raises ValueError for unknown policy name
+    """
+    if name == POLICY_NEWEST:
+        return SelectionPolicy()
+    if name == POLICY_NEWEST_IN_FOLDER:
+        return NewestInFolderPolicy(folder)
+    if name == POLICY_NEWEST_NOT_PRINTED:
+        return NewestNotPrintedPolicy()
+    if name == POLICY_RECENTLY_SELECTED:
+        return RecentlySelectedPolicy()
+    raise ValueError(f"Unknown selection policy '{name}'")
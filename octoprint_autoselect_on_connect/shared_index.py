@@ -0,0 +1,155 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import os
+import sqlite3
+import threading
+from typing import Iterable, Iterator, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:  # not on Windows, every instance writes then
+    fcntl = None
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    date INTEGER NOT NULL,
+    display TEXT NOT NULL,
+    name TEXT NOT NULL,
+    short_name TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS files_date ON files (date DESC, path DESC);
+CREATE INDEX IF NOT EXISTS files_display ON files (display);
+CREATE INDEX IF NOT EXISTS files_short_name ON files (short_name);
+"""
+
+
+class SharedFileIndex:
+    """
+    Local file index in SQLite database that several OctoPrint instances sharing one upload folder can read.
+    Only the instance holding the lock file rebuilds it, others take over when the writer goes away.
+    Every instance upserts and deletes files it was told about, OctoPrint tells only the instance that changed them.
+    Rows are (date, path, display, name, short_name).
+    """
+
+    def __init__(self, db_path: str):
+        self._db_path = db_path
+        # reads and writes have connections of their own, so lookups don't wait for a rebuild
+        self._mutex = threading.RLock()
+        self._connection: Optional[sqlite3.Connection] = None
+        self._write_mutex = threading.RLock()
+        self._write_connection: Optional[sqlite3.Connection] = None
+        self._lock_file = None
+        self.is_writer = False
+
+    def open(self):
+        with self._mutex, self._write_mutex:
+            if self._connection is not None:
+                return
+            os.makedirs(os.path.dirname(self._db_path) or ".", exist_ok=True)
+            write_connection = self._connect()
+            # readers don't block the writer and vice versa
+            write_connection.execute("PRAGMA journal_mode=WAL")
+            write_connection.executescript(SCHEMA)
+            self._write_connection = write_connection
+            self._connection = self._connect()
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self._db_path, timeout=10, check_same_thread=False, isolation_level=None)
+        connection.execute("PRAGMA synchronous=NORMAL")
+        return connection
+
+    def close(self):
+        with self._mutex, self._write_mutex:
+            for connection in (self._connection, self._write_connection):
+                if connection is not None:
+                    connection.close()
+            self._connection = None
+            self._write_connection = None
+            if self._lock_file is not None:
+                self._lock_file.close()  # releases the lock
+                self._lock_file = None
+            self.is_writer = False
+
+    def try_become_writer(self) -> bool:
+        """
+        Returns True if this instance just became the writer
+        """
+        with self._write_mutex:
+            if self.is_writer:
+                return False
+            if fcntl is None:
+                self.is_writer = True
+                return True
+            lock_file = open(self._db_path + ".lock", "a+")
+            try:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock_file.close()
+                return False
+            self._lock_file = lock_file
+            self.is_writer = True
+            return True
+
+    def replace_all(self, rows: Iterable[Tuple[int, str, str, str, str]]):
+        with self._write_mutex:
+            connection = self._write_connection
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                connection.execute("DELETE FROM files")
+                connection.executemany("INSERT OR REPLACE INTO files (date, path, display, name, short_name) "
+                                       "VALUES (?, ?, ?, ?, ?)", rows)
+                connection.execute("COMMIT")
+            except Exception:
+                connection.execute("ROLLBACK")
+                raise
+
+    def upsert(self, row: Tuple[int, str, str, str, str]):
+        with self._write_mutex:
+            self._write_connection.execute("INSERT OR REPLACE INTO files (date, path, display, name, short_name) "
+                                     "VALUES (?, ?, ?, ?, ?)", row)
+
+    def delete(self, path: str) -> bool:
+        """
+        Returns False if path was not in index
+        """
+        with self._write_mutex:
+            return self._write_connection.execute("DELETE FROM files WHERE path = ?", (path,)).rowcount > 0
+
+    def iter_newest(self, batch_size: int = 100) -> Iterator[Tuple[int, str, str, str]]:
+        """
+        (date, path, display, name) of newest files first, read in batches only as far as iterated
+        """
+        rows = self._query("SELECT date, path, display, name FROM files ORDER BY date DESC, path DESC LIMIT ?",
+                           (batch_size,))
+        while rows:
+            yield from rows
+            if len(rows) < batch_size:
+                return
+            date, path = rows[-1][0], rows[-1][1]
+            rows = self._query("SELECT date, path, display, name FROM files WHERE date < ? OR (date = ? AND path < ?) "
+                               "ORDER BY date DESC, path DESC LIMIT ?", (date, date, path, batch_size))
+
+    def entry(self, path: str) -> Optional[Tuple[int, str, str, str]]:
+        return self._query_one("SELECT date, path, display, name FROM files WHERE path = ?", (path,))
+
+    def lookup(self, key: str) -> Optional[str]:
+        """
+        Path of newest file having key as its path, display name or short name
+        """
+        row = self._query_one("SELECT path FROM files WHERE path = ? OR display = ? OR short_name = ? "
+                              "ORDER BY date DESC, path DESC LIMIT 1", (key, key, key))
+        return row[0] if row else None
+
+    def count(self) -> int:
+        row = self._query_one("SELECT COUNT(*) FROM files")
+        return row[0] if row else 0
+
+    def _query(self, sql: str, parameters: tuple = ()) -> list:
+        with self._mutex:
+            return self._connection.execute(sql, parameters).fetchall()
+
+    def _query_one(self, sql: str, parameters: tuple = ()) -> Optional[tuple]:
+        with self._mutex:
+            return self._connection.execute(sql, parameters).fetchone()
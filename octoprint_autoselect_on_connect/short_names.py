@@ -0,0 +1,112 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import functools
+import hashlib
+import re
+from typing import Callable, Dict, Iterable, Optional
+
+from .data_file import load_json, save_json
+
+_GCODE_SUFFIX = re.compile(r"\.gcode$")
+_NOT_ALPHANUMERIC = re.compile(r"[^a-z0-9]+")
+
+# 8 character name, 3 character extension
+DOS_NAME_LENGTH = 8
+DOS_EXTENSION = ".gco"
+
+# hash and extension lengths in order of preference, shorter ones are used when name length is limited
+_HASH_AND_EXTENSION = ((6, ".gcode"), (6, ".gco"), (5, ".gco"), (4, ".gco"))
+# shortest name that has 4 hash characters and an extension firmwares and OctoPrint know
+MIN_NAME_LENGTH = 8
+
+
+@functools.lru_cache(maxsize=4096)
+def short_filename(original_name: str, max_length: Optional[int] = None, dos_names: bool = False,
+                   salt: str = "") -> str:
+    """
+    Create unique(ish) short-ish file names without knowing names of other files,
+    salt is used to get another name when the first one is already taken.
+    Raises ValueError if max_length is less than MIN_NAME_LENGTH.
+    """
+    if max_length is not None and max_length < MIN_NAME_LENGTH:
+        raise ValueError(f"File name length {max_length} is less than {MIN_NAME_LENGTH}")
+    base = _GCODE_SUFFIX.sub("", original_name.lower())
+    base = _NOT_ALPHANUMERIC.sub("_", base)  # Keep alphanum + underscore
+    base = base.strip("_")
+
+    # Hash the base name
+    hash_part = hashlib.sha1((base + salt).encode()).hexdigest()
+
+    if dos_names:
+        name_length = DOS_NAME_LENGTH if max_length is None else min(DOS_NAME_LENGTH,
+                                                                     max_length - len(DOS_EXTENSION))
+        # as much of the name as fits in front of 5 hash characters
+        prefix = base.replace("_", "")[:max(0, name_length - 5)]
+        return f"{prefix}{hash_part[:name_length - len(prefix)]}{DOS_EXTENSION}"
+
+    hash_length, extension = next((length, extension) for length, extension in _HASH_AND_EXTENSION
+                                  if max_length is None or length + len(extension) <= max_length)
+
+    # Use first 12 chars of the cleaned name as prefix, if there is room for it and separator
+    prefix_length = 12 if max_length is None else min(12, max(0, max_length - hash_length - len(extension) - 1))
+    prefix = base[:prefix_length].strip("_")
+
+    return f"{prefix}_{hash_part[:hash_length]}{extension}" if prefix else f"{hash_part[:hash_length]}{extension}"
+
+
+class ShortNameRegistry:
+    """
+    Short names assigned to local files that have "links" on SD card.
+    A name that is already taken by another file is salted until it is free,
+    so files that got their name first keep it.
+    """
+
+    def __init__(self, file_path: str, name_format: str, name_function: Callable[[str, str], str]):
+        self._file_path = file_path
+        self._name_format = name_format
+        self._name_function = name_function
+        self._names: Dict[str, str] = {}  # local path -> short name
+        self._paths: Dict[str, str] = {}  # short name -> local path
+        self.changed = False
+
+    def load(self):
+        data = load_json(self._file_path)
+        if data.get("format", self._name_format) != self._name_format:
+            # names were made for different file name limits
+            data = dict()
+            self.changed = True
+        self._names = data.get("names", dict())
+        self._paths = {name: path for path, name in self._names.items()}
+
+    def save(self):
+        save_json(self._file_path, {"format": self._name_format, "names": self._names})
+        self.changed = False
+
+    def assign(self, path: str, original_name: str) -> str:
+        name = self._names.get(path)
+        if name is not None:
+            return name
+
+        attempt = 0
+        name = self._name_function(original_name, "")
+        while name in self._paths:
+            attempt += 1
+            name = self._name_function(original_name, f"#{attempt}")
+
+        self._names[path] = name
+        self._paths[name] = path
+        self.changed = True
+        return name
+
+    def path_of(self, name: str) -> Optional[str]:
+        return self._paths.get(name)
+
+    def retain(self, paths: Iterable[str]):
+        """
+        Forget names of all other files
+        """
+        paths = set(paths)
+        for path in [x for x in self._names if x not in paths]:
+            del self._paths[self._names.pop(path)]
+            self.changed = True
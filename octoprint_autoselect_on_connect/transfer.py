@@ -0,0 +1,80 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import threading
+from typing import Callable, List, Optional, Tuple
+
+# replies of Marlin style firmwares as (success, failure) pairs, to M28
+SD_WRITE_STARTED = ("writing to file",), ("open failed",)
+# to M29
+SD_WRITE_DONE = ("done saving file",), ("error writing to file",)
+# to M30
+SD_DELETE_DONE = ("file deleted",), ("deletion failed",)
+
+
+class SdWriteTracker:
+    """
+    Follow printer replies to one SD command: M28 opening a file, M29 closing it or M30 deleting it.
+    feed() is called from serial comm thread for every received line, so it must be cheap.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._file_name: Optional[str] = None
+        self._done, self._failed = SD_WRITE_DONE
+        self._result: Optional[bool] = None
+
+    def begin(self, file_name: str, replies: Tuple[Tuple[str, ...], Tuple[str, ...]]):
+        """
+        Start following replies, one of SD_WRITE_STARTED, SD_WRITE_DONE or SD_DELETE_DONE
+        """
+        with self._condition:
+            self._file_name = file_name
+            self._done, self._failed = replies
+            self._result = None
+
+    def feed(self, line: str):
+        if self._file_name is None:
+            return
+        lower = line.lower()
+        with self._condition:
+            if self._file_name is None:
+                return
+            if any(x in lower for x in self._done):
+                self._result = True
+                self._condition.notify_all()
+            elif any(x in lower for x in self._failed):
+                self._result = False
+                self._condition.notify_all()
+
+    def wait(self, timeout: float) -> Optional[bool]:
+        """
+        Wait until file is confirmed (True), failed (False) or timeout elapsed (None)
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: self._result is not None, timeout)
+            result = self._result
+            self._file_name = None
+            return result
+
+
+class CommandStream:
+    """
+    Send commands to printer and count what was sent.
+    Commands of one call are queued together, so M28 ... M29 block is never left open,
+    OctoPrint sends them one at a time waiting for "ok" of each.
+    """
+
+    def __init__(self, send: Callable[[List[str]], None]):
+        self._send = send
+        self.lines_sent = 0
+        self.bytes_sent = 0
+
+    def reset_stats(self):
+        self.lines_sent = 0
+        self.bytes_sent = 0
+
+    def send(self, commands: List[str]):
+        self._send(commands)
+        self.lines_sent += len(commands)
+        self.bytes_sent += sum(len(x.encode("utf-8")) + 1 for x in commands)  # newline
@@ -0,0 +1,101 @@
+# coding=utf-8
+from __future__ import absolute_import
+
+import heapq
+import itertools
+import logging
+import threading
+import time
+from typing import Callable, List, Optional, Tuple
+
+
+class CancelToken:
+    """
+    Cancels jobs that have not run yet, and tells running jobs to stop waiting
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+
+    def cancel(self):
+        self._event.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def wait(self, timeout: float) -> bool:
+        """
+        Sleep for timeout seconds, returns True if cancelled before that
+        """
+        return self._event.wait(timeout)
+
+
+class JobWorker:
+    """
+    Single thread that runs scheduled jobs one at a time in order of their due time.
+    Connect and sync jobs never run in parallel, and there are no timer threads to create or cancel.
+    """
+
+    def __init__(self, name: str, logger: Optional[logging.Logger] = None):
+        self._name = name
+        self._logger = logger or logging.getLogger(__name__)
+        self._condition = threading.Condition()
+        self._jobs: List[Tuple[float, int, Callable[[], None], CancelToken]] = []
+        self._sequence = itertools.count()
+        self._thread: Optional[threading.Thread] = None
+        self._stopped = False
+
+    def submit(self, function: Callable[[], None], token: Optional[CancelToken] = None) -> CancelToken:
+        return self.schedule(0, function, token)
+
+    def schedule(self, delay: float, function: Callable[[], None],
+                 token: Optional[CancelToken] = None) -> CancelToken:
+        """
+        Run function after delay seconds unless token is cancelled before that
+        """
+        token = token or CancelToken()
+        with self._condition:
+            heapq.heappush(self._jobs, (time.monotonic() + max(delay, 0), next(self._sequence), function, token))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=self._name, daemon=True)
+                self._thread.start()
+            self._condition.notify()
+        return token
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            for _, _, _, token in self._jobs:
+                token.cancel()
+            self._jobs = []
+            self._condition.notify()
+
+    def _next_job(self) -> Optional[Tuple[Callable[[], None], CancelToken]]:
+        with self._condition:
+            while not self._stopped:
+                while self._jobs and self._jobs[0][3].cancelled:
+                    heapq.heappop(self._jobs)
+                if not self._jobs:
+                    self._condition.wait()
+                    continue
+                remaining = self._jobs[0][0] - time.monotonic()
+                if remaining > 0:
+                    self._condition.wait(remaining)
+                    continue
+                _, _, function, token = heapq.heappop(self._jobs)
+                return function, token
+            return None
+
+    def _run(self):
+        while True:
+            job = self._next_job()
+            if job is None:
+                return
+            function, token = job
+            if token.cancelled:
+                continue
+            try:
+                function()
+            except Exception:
+                self._logger.exception("Job failed")